@@ -1,9 +1,376 @@
-from distutils import util
 from cmd import Cmd
 from tabulate import tabulate
+import json
+import os
+import time
 import matplotlib.pyplot as plt
+import numpy as np
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 from main import MainPrompt
+from encryption import strtobool
+
+# Ranges are evolved this many starting values at a time
+COLLATZ_BLOCK = 1024 * 1024
+# Largest odd value whose 3x+1 still fits an int64, lanes that go beyond continue with Python integers
+COLLATZ_INT64_LIMIT = (2**63 - 2) // 3
+# Peaks that do not fit a uint64 are stored as this value (the exact ones are returned separately)
+COLLATZ_PEAK_OVERFLOW = 2**64 - 1
+# Default amount of numbers (1 up to this) that the stopping time cache remembers, 10 bytes each
+COLLATZ_CACHE_SIZE = 2**24
+# stopping_times stores its results in a cache it owns after every block of (at most) this many numbers
+COLLATZ_CACHE_BLOCK = 64 * 1024
+# Layout of a cache entry: the stopping time + 1 (0 means unknown) and the peak of the trajectory
+COLLATZ_CACHE_DTYPE = np.dtype([('steps', '<u2'), ('peak', '<u8')])
+# Sweeps hand out this many starting values per task, a finished chunk is the unit that is checkpointed
+COLLATZ_SWEEP_CHUNK = 4 * 1024 * 1024
+
+
+class CollatzCache(object):
+    # Remembers the stopping time and peak of every number below size in a memory-mapped .npy file that is
+    # reused between sessions. Trajectories stop as soon as they reach a number that is known, the table
+    # fills up with every trajectory that reaches 1. Stopping times of 65535 steps or more are not stored.
+    # A read-only cache (the sweep workers have one) only looks numbers up, the owner of the table stores them.
+    def __init__(self, path, size=COLLATZ_CACHE_SIZE, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        if os.path.isfile(path) or read_only:
+            # The size of an existing table is fixed
+            self.table = np.load(path, mmap_mode='r' if read_only else 'r+')
+            if self.table.dtype != COLLATZ_CACHE_DTYPE or self.table.ndim != 1:
+                raise ValueError('Not a stopping time cache')
+        else:
+            self.table = np.lib.format.open_memmap(path, mode='w+', dtype=COLLATZ_CACHE_DTYPE, shape=(size,))
+        self.size = len(self.table)
+        # Everything from here on is unknown, lookups of higher values are skipped
+        self.top = self.__find_top__()
+        self.lookups = 0
+        self.hits = 0
+
+    def __find_top__(self):
+        # One more than the highest known number, the table is scanned from the end a block at a time
+        steps = self.table['steps']
+        for end in range(self.size, 0, -COLLATZ_CACHE_BLOCK):
+            known = np.flatnonzero(steps[max(end - COLLATZ_CACHE_BLOCK, 0):end])
+            if len(known):
+                return max(end - COLLATZ_CACHE_BLOCK, 0) + int(known[-1]) + 1
+        return 0
+
+    def lookup(self, values):
+        # Return a mask of the values that are known and their stopping times and peaks, the caller counts
+        # the hits it could use (a known stopping time that passes the threshold is of no use)
+        found = np.zeros(len(values), bool)
+        below = np.flatnonzero((values > 1) & (values < self.top))
+        if not len(below):
+            return found, None, None
+
+        entries = self.table[values[below]]
+        known = entries['steps'] != 0
+        found[below[known]] = True
+        self.lookups += len(below)
+        return found, entries['steps'][known].astype(np.uint32) - 1, entries['peak'][known]
+
+    def store(self, numbers, steps, peaks):
+        # Remember the exact stopping times (and peaks) of the numbers that are small enough
+        keep = (numbers < self.size) & (steps < 2**16 - 1) & (peaks < 2**63)
+        # The peak goes first, a lookup that sees the steps of an entry must also see its peak
+        self.table['peak'][numbers[keep]] = peaks[keep]
+        self.table['steps'][numbers[keep]] = steps[keep] + 1
+        if keep.any():
+            self.top = max(self.top, int(numbers[keep].max()) + 1)
+
+    def known(self):
+        return int(np.count_nonzero(self.table['steps']))
+
+    def flush(self):
+        if not self.read_only:
+            self.table.flush()
+
+    def close(self):
+        self.flush()
+        self.table = None
+
+
+def stopping_time(num, threshold, steps=0, peak=None):
+    # Follow a single number with exact (Python) integers until it reaches 1 or the threshold,
+    # returns the amount of steps and the highest value. Can continue a trajectory that was started elsewhere.
+    peak = num if peak is None else peak
+    while num != 1 and steps < threshold:
+        if num % 2 == 0:
+            num //= 2
+        else:
+            num = num * 3 + 1
+            peak = max(peak, num)
+        steps += 1
+
+    return steps, peak
+
+
+def __trailing_zeros__(x):
+    # Amount of trailing zero bits of every (non-zero) value, x & -x keeps only the lowest set bit
+    # and frexp reads its exponent (exact, powers of 2 are exactly representable as floats)
+    return (np.frexp((x & -x).astype(np.float64))[1] - 1).astype(np.uint32)
+
+
+def stopping_times(start, stop, threshold, block=COLLATZ_BLOCK, cache=None):
+    # Compute the stopping time (steps until 1, at most threshold) and the peak of every n in [start, stop).
+    # Whole blocks of starting values are evolved at once with int64 arrays: every round applies 3x + 1 to
+    # all (odd) lanes and then all of the halvings that follow at once (by stripping the trailing zero bits),
+    # lanes that reached 1 (or the threshold) are dropped so the work shrinks with the amount of active lanes.
+    # A lane that would overflow int64 is finished with exact integers instead. With a cache, lanes also stop
+    # as soon as they reach a known number, and the results are stored in it. Returns a uint32 array of
+    # steps, a uint64 array of peaks and {n: peak} for the peaks that do not fit a uint64.
+    if start < 1 or stop <= start:
+        raise ValueError('The range must start at 1 or more and may not be empty')
+
+    steps = np.empty(stop - start, np.uint32)
+    peaks = np.empty(stop - start, np.uint64)
+    big_peaks = {}
+    if cache is not None and not cache.read_only:
+        # The results of a block are stored before the next one runs, smaller blocks let the trajectories
+        # of a first pass over a range find the numbers just below them in the cache already
+        block = min(block, COLLATZ_CACHE_BLOCK)
+
+    for offset in range(0, stop - start, block):
+        first = start + offset
+        size = min(block, stop - first)
+        if first + size - 1 > COLLATZ_INT64_LIMIT:
+            # The starting values themselves are already too large
+            for i in range(size):
+                steps[offset + i], peak = stopping_time(first + i, threshold)
+                peaks[offset + i] = min(peak, COLLATZ_PEAK_OVERFLOW)
+                if peak > COLLATZ_PEAK_OVERFLOW:
+                    big_peaks[first + i] = peak
+            continue
+
+        # The lanes that are still active: their position, current (odd) value, steps and peak
+        pos = np.arange(offset, offset + size)
+        pk = np.arange(first, first + size, dtype=np.int64)
+        zeros = __trailing_zeros__(pk)
+        cur = pk >> zeros.astype(np.int64)
+        cnt = np.minimum(zeros, threshold)
+
+        while len(pos):
+            if cache is not None:
+                # The rest of the trajectory is known, the lane ends right away
+                # (unless that passes the threshold, those lanes go on so their peaks stop at the threshold as well)
+                found, known_steps, known_peaks = cache.lookup(cur)
+                if found.any():
+                    idx = np.flatnonzero(found)
+                    fits = cnt[idx] + known_steps < threshold
+                    idx = idx[fits]
+                    cache.hits += len(idx)
+                    cnt[idx] += known_steps[fits]
+                    pk[idx] = np.maximum(pk[idx], known_peaks[fits].astype(np.int64))
+                    cur[idx] = 1
+
+            done = (cur == 1) | (cnt >= threshold)
+            overflow = ~done & (cur > COLLATZ_INT64_LIMIT)
+
+            if done.any() or overflow.any():
+                steps[pos[done]] = cnt[done]
+                peaks[pos[done]] = pk[done]
+
+                for i in np.flatnonzero(overflow):
+                    n_steps, peak = stopping_time(int(cur[i]), threshold, int(cnt[i]), int(pk[i]))
+                    steps[pos[i]] = n_steps
+                    peaks[pos[i]] = min(peak, COLLATZ_PEAK_OVERFLOW)
+                    if peak > COLLATZ_PEAK_OVERFLOW:
+                        big_peaks[start + int(pos[i])] = peak
+
+                keep = ~(done | overflow)
+                pos, cur, cnt, pk = pos[keep], cur[keep], cnt[keep], pk[keep]
+
+            # 3x + 1 is the highest value until the next odd one, the halvings are counted but never exceed the threshold
+            cur = 3 * cur + 1
+            np.maximum(pk, cur, out=pk)
+            zeros = __trailing_zeros__(cur)
+            cur >>= zeros.astype(np.int64)
+            cnt = np.minimum(cnt + 1 + zeros, threshold).astype(np.uint32)
+
+        if cache is not None and not cache.read_only:
+            # Only the trajectories that reached 1 before the threshold are exact
+            part = slice(offset, offset + size)
+            exact = steps[part] < threshold
+            cache.store(np.arange(first, first + size)[exact], steps[part][exact], peaks[part][exact])
+
+    return steps, peaks, big_peaks
+
+
+def __chunk_records__(first, values, big_values=None):
+    # The numbers in a chunk whose value is higher than that of every smaller number in the chunk, as [n, value]
+    # pairs. Values that do not fit (big_values) are always candidates, the exact filter below sorts them out.
+    values = values.astype(np.uint64)
+    prev = np.concatenate([np.zeros(1, np.uint64), np.maximum.accumulate(values)[:-1]])
+    candidates = set(np.flatnonzero(values > prev).tolist())
+    if big_values:
+        candidates.update(n - first for n in big_values)
+
+    records = []
+    for i in sorted(candidates):
+        value = big_values.get(first + i, int(values[i])) if big_values else int(values[i])
+        if not records or value > records[-1][1]:
+            records.append([first + i, value])
+    return records
+
+
+def __sweep_chunk__(task):
+    # Worker of sweep(), summarises the chunk [first, stop): its record stopping times and peaks, the histogram
+    # of the stopping times (counts from the lowest one on) and how many of them reached the threshold.
+    # The cache is only read here, the steps and peaks of the numbers it covers go back to the parent to be stored.
+    first, stop, threshold, cache_path = task
+    cache = CollatzCache(cache_path, read_only=True) if cache_path is not None else None
+    try:
+        steps, peaks, big_peaks = stopping_times(first, stop, threshold, cache=cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    # Stopping times that reached the threshold are not exact, they cannot be records
+    exact = np.where(steps < threshold, steps, 0)
+    low = int(steps.min())
+    covered = max(min(cache.size - first, stop - first), 0) if cache is not None else 0
+    return {
+        'first': first,
+        'steps': __chunk_records__(first, exact),
+        'peaks': __chunk_records__(first, peaks, big_peaks),
+        'histogram': [low, np.bincount(steps)[low:].tolist()],
+        'reached': int((steps >= threshold).sum()),
+        'lookups': cache.lookups if cache is not None else 0,
+        'hits': cache.hits if cache is not None else 0,
+        'cache': (steps[:covered], peaks[:covered]),
+    }
+
+
+def __add_histogram__(histogram, low, counts):
+    # Add the counts of the stopping times low, low + 1, ... to the histogram, which grows when needed
+    end = low + len(counts)
+    if end > len(histogram):
+        histogram = np.concatenate([histogram, np.zeros(end - len(histogram), np.uint64)])
+    histogram[low:end] += np.array(counts, np.uint64)
+    return histogram
+
+
+def __merge_records__(chunks, key):
+    # Chunk records are only records of the whole range if they beat everything in the chunks before them
+    records = []
+    for chunk in sorted(chunks, key=lambda c: c['first']):
+        for n, value in chunk[key]:
+            if not records or value > records[-1][1]:
+                records.append([n, value])
+    return records
+
+
+def __load_checkpoint__(path, sweep):
+    # A checkpoint is a JSON line that describes the sweep followed by one line per finished chunk.
+    # Returns the chunks that were finished before and their merged histogram, the checkpoint must belong
+    # to the same sweep. A line that was cut off (the run was killed while writing it) is removed.
+    done = {}
+    histogram = np.zeros(0, np.uint64)
+    if path is None or not os.path.isfile(path):
+        return done, histogram
+
+    with open(path, 'rb') as f:
+        lines = f.readlines()
+
+    if lines and not lines[-1].endswith(b'\n'):
+        lines.pop()
+        with open(path, 'r+b') as f:
+            f.truncate(sum(len(line) for line in lines))
+    if not lines:
+        # Not even the description of the sweep made it, start over
+        os.remove(path)
+        return done, histogram
+
+    try:
+        entries = [json.loads(line) for line in lines]
+    except ValueError:
+        raise ValueError('The checkpoint is corrupt')
+
+    if entries[0].get('sweep') != sweep:
+        raise ValueError('The checkpoint belongs to a different range, threshold or chunk size')
+
+    for entry in entries[1:]:
+        histogram = __add_histogram__(histogram, *entry.pop('histogram'))
+        done[entry['first']] = entry
+    return done, histogram
+
+
+def __append_checkpoint__(path, entry):
+    # Only the new chunk is written (one line), the cost per chunk does not grow with the size of the sweep
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def sweep(start, stop, threshold, chunk=COLLATZ_SWEEP_CHUNK, workers=None, checkpoint=None, cache_path=None,
+          cache_size=COLLATZ_CACHE_SIZE, progress=None):
+    # Compute [start, stop) in chunks on a pool of processes. Chunks are handed out as workers become free
+    # (a few in flight per worker), so slow chunks do not hold the others up. Every finished chunk is written to
+    # the checkpoint, a sweep that is started again with the same checkpoint only computes the missing chunks.
+    # Returns the record stopping times and peaks as [n, value] pairs, the merged histogram and the stats.
+    if start < 1 or stop <= start:
+        raise ValueError('The range must start at 1 or more and may not be empty')
+
+    sweep_id = {'start': start, 'stop': stop, 'threshold': threshold, 'chunk': chunk}
+    done, histogram = __load_checkpoint__(checkpoint, sweep_id)
+    if checkpoint is not None and not os.path.isfile(checkpoint):
+        __append_checkpoint__(checkpoint, {'sweep': sweep_id})
+    # Created (or opened) before the workers open it, only this process writes to it
+    cache = CollatzCache(cache_path, cache_size) if cache_path is not None else None
+
+    tasks = deque((first, min(first + chunk, stop), threshold, cache_path)
+                  for first in range(start, stop, chunk) if first not in done)
+    resumed = len(done)
+    workers = workers or os.cpu_count() or 1
+    computed = 0
+    begin = time.perf_counter()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+            window = 2 * workers
+            while tasks or pending:
+                while tasks and len(pending) < window:
+                    task = tasks.popleft()
+                    pending[pool.submit(__sweep_chunk__, task)] = task
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    first, end = pending.pop(future)[:2]
+                    result = future.result()
+                    known_steps, known_peaks = result.pop('cache')
+                    if cache is not None and len(known_steps):
+                        exact = known_steps < threshold
+                        cache.store(np.arange(first, first + len(known_steps))[exact], known_steps[exact], known_peaks[exact])
+                        cache.flush()
+
+                    if checkpoint is not None:
+                        __append_checkpoint__(checkpoint, result)
+                    histogram = __add_histogram__(histogram, *result.pop('histogram'))
+                    done[first] = result
+                    computed += end - first
+
+                if progress is not None:
+                    progress(len(done), len(done) + len(tasks) + len(pending))
+    finally:
+        if cache is not None:
+            cache.close()
+
+    elapsed = max(time.perf_counter() - begin, 1e-9)
+
+    stats = {
+        'numbers': stop - start,
+        'computed': computed,
+        'chunks': len(done),
+        'resumed': resumed,
+        'workers': workers,
+        'elapsed': elapsed,
+        'reached': sum(c['reached'] for c in done.values()),
+        'lookups': sum(c['lookups'] for c in done.values()),
+        'hits': sum(c['hits'] for c in done.values()),
+    }
+    return __merge_records__(done.values(), 'steps'), __merge_records__(done.values(), 'peaks'), histogram, stats
 
 
 class Prompt(Cmd):
@@ -21,6 +388,34 @@ class Prompt(Cmd):
         'THRESHOLD': {
             'value': 20000,
             'description': 'Stop after x iterations',
+        },
+        'RANGE': {
+            'value': None,
+            'description': 'First and last number for calculate-range (start:stop)',
+        },
+        'OUTPUT': {
+            'value': None,
+            'description': 'File (.npz) to store the results of calculate-range or sweep in',
+        },
+        'CACHE': {
+            'value': None,
+            'description': 'File (.npy) that remembers stopping times between sessions',
+        },
+        'CACHE_SIZE': {
+            'value': COLLATZ_CACHE_SIZE,
+            'description': 'Amount of numbers a new CACHE remembers',
+        },
+        'WORKERS': {
+            'value': None,
+            'description': 'Amount of processes for sweep (all cores if unset)',
+        },
+        'CHUNK': {
+            'value': COLLATZ_SWEEP_CHUNK,
+            'description': 'Amount of numbers that a sweep worker computes per task',
+        },
+        'CHECKPOINT': {
+            'value': None,
+            'description': 'File (.jsonl) that sweep stores finished chunks in, to resume an interrupted sweep',
         }
     }
 
@@ -29,7 +424,9 @@ class Prompt(Cmd):
         cmd_list = [
             ['settings', 'View current settings'],
             ['set', 'Set the value of a setting'],
-            ['calculate', 'Calculate the amount of steps']
+            ['calculate', 'Calculate the amount of steps'],
+            ['calculate-range', 'Calculate the amount of steps and the peak of every number in RANGE'],
+            ['sweep', 'Find the record stopping times and peaks in RANGE on all cores']
         ]
         print(tabulate(cmd_list, stralign="center", tablefmt="fancy_grid",
                        headers=[self.cls['BLUE'] + "Command" + self.cls['RESET'],
@@ -53,7 +450,22 @@ class Prompt(Cmd):
         opt_value = ' '.join(arr)
 
         # Check if the specified setting exists
-        if opt_name in self.settings:
+        if opt_name == 'RANGE':
+            try:
+                start, stop = [int(v) for v in opt_value.split(':')]
+                if start < 1 or stop < start:
+                    raise ValueError()
+                self.settings['RANGE']['value'] = '{start}:{stop}'.format(start=start, stop=stop)
+            except ValueError:
+                print(self.cls['RED'] + 'You must enter start:stop (with 0 < start <= stop).')
+                return
+
+            print(self.cls['GREEN'] + 'Successfully updated the settings.')
+        elif opt_name in ('OUTPUT', 'CACHE', 'CHECKPOINT'):
+            # An empty value unsets the file
+            self.settings[opt_name]['value'] = opt_value or None
+            print(self.cls['GREEN'] + 'Successfully updated the settings.')
+        elif opt_name in self.settings:
             try:
                 num = int(opt_value)
                 if num < 1:
@@ -71,14 +483,33 @@ class Prompt(Cmd):
         num = self.settings['NUMBER']['value']
         thres = self.settings['THRESHOLD']['value']
 
+        if num is None:
+            print(self.cls['RED'] + 'There was no number set.')
+            return
+
+        cache = self.__open_cache__()
+        if cache is False:
+            return
+
         success = True
 
         values = [num]
         s = 0  # Amount of steps
+        cached = None
         while num != 1:
+            if cache is not None and 1 < num < cache.size:
+                # The amount of steps that are left is known, a plot rebuilds the rest of the values below
+                found, known_steps, _peaks = cache.lookup(np.array([num], np.int64))
+                if found[0] and s + int(known_steps[0]) < thres:
+                    cached = int(known_steps[0])
+                    cache.hits += 1
+                    s += cached
+                    break
+
             # Check if number is even
             if num % 2 == 0:
-                num /= 2
+                # Floor division keeps num an int, /= would turn it into a float that loses precision past 2**53
+                num //= 2
             else:
                 num = num * 3 + 1
             s += 1  # Python does not support ++ :(
@@ -88,7 +519,14 @@ class Prompt(Cmd):
                 success = False
                 break
 
-        if success:
+        if cache is not None:
+            if success and cached is None and values[0] < cache.size:
+                cache.store(np.array([values[0]]), np.array([s]), np.array([max(values)], np.uint64))
+            cache.close()
+
+        if cached is not None:
+            print(self.cls['GREEN'] + 'Finished in ' + str(s) + ' steps. (' + str(cached) + ' from the cache)' + self.cls['RESET'])
+        elif success:
             print(self.cls['GREEN'] + 'Finished in ' + str(s) + ' steps.' + self.cls['RESET'])
         else:
             print(self.cls['GREEN'] + 'Finished in ' + str(s) + ' steps. (Threshold reached)' + self.cls['RESET'])
@@ -96,12 +534,19 @@ class Prompt(Cmd):
         while True:
             try:
                 # Ask if the results need to be plotted and try to cast the input to a boolean
-                plot_result = bool(util.strtobool(input('Would you like to plot the result? Enter \'yes\' or \'no\': ')))
+                plot_result = strtobool(input('Would you like to plot the result? Enter \'yes\' or \'no\': '))
                 break
             except ValueError:
                 print(self.cls['RED'] + 'You must enter either \'yes\' or \'no\': ')
 
         if plot_result:
+            if cached is not None:
+                # The cache only knew the amount of steps, the plot needs every value until 1 (cached steps at most)
+                num = values[-1]
+                while num != 1:
+                    num = num // 2 if num % 2 == 0 else num * 3 + 1
+                    values.append(num)
+
             # plt.plot(list(range(0, len(values))), values)
             plt.plot(values)
             plt.title('Collatz Conjecture (3x+1)')
@@ -109,6 +554,132 @@ class Prompt(Cmd):
             plt.ylabel('Value of n')
             plt.show()
 
+    def do_calculate_range(self, _ln):
+        if self.settings['RANGE']['value'] is None:
+            print(self.cls['RED'] + 'There was no range set.')
+            return
+
+        start, stop = [int(v) for v in self.settings['RANGE']['value'].split(':')]
+        thres = self.settings['THRESHOLD']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        cache = self.__open_cache__()
+        if cache is False:
+            return
+
+        begin = time.perf_counter()
+        try:
+            steps, peaks, big_peaks = stopping_times(start, stop + 1, thres, cache=cache)
+        finally:
+            if cache is not None:
+                cache.flush()
+        elapsed = max(time.perf_counter() - begin, 1e-9)
+
+        longest = int(steps.argmax())
+        highest = max(big_peaks, key=big_peaks.get) - start if big_peaks else int(peaks.argmax())
+        print(tabulate([[stop - start + 1, '{n} ({s} steps)'.format(n=start + longest, s=steps[longest]),
+                         '{n} (peak {p})'.format(n=start + highest, p=big_peaks.get(start + highest, peaks[highest])),
+                         int((steps >= thres).sum()), '{speed:.0f}/s'.format(speed=(stop - start + 1) / elapsed)]],
+                       stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Numbers" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Longest" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Highest" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Threshold reached" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Speed" + self.cls['RESET']]))
+
+        if cache is not None:
+            self.__print_cache__(cache)
+            cache.close()
+
+        if out_path is not None:
+            try:
+                np.savez(out_path, start=start, steps=steps, peaks=peaks)
+            except OSError as e:
+                print(self.cls['RED'] + 'Could not store the results: ' + str(e))
+                return
+            print(self.cls['GREEN'] + 'Stored the steps and peaks: ' + self.cls['RESET'] + out_path)
+
+    def do_sweep(self, _ln):
+        if self.settings['RANGE']['value'] is None:
+            print(self.cls['RED'] + 'There was no range set.')
+            return
+
+        start, stop = [int(v) for v in self.settings['RANGE']['value'].split(':')]
+        thres = self.settings['THRESHOLD']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        try:
+            step_records, peak_records, histogram, stats = sweep(
+                start, stop + 1, thres, self.settings['CHUNK']['value'], self.settings['WORKERS']['value'],
+                self.settings['CHECKPOINT']['value'], self.settings['CACHE']['value'], self.settings['CACHE_SIZE']['value'],
+                progress=lambda finished, total: print('\r{finished}/{total} chunks'.format(finished=finished, total=total),
+                                                       end='', flush=True))
+        except (OSError, ValueError) as e:
+            print(self.cls['RED'] + 'Could not sweep the range: ' + str(e))
+            return
+        print()
+
+        records = [['Stopping time', n, value] for n, value in step_records] + [['Peak', n, value] for n, value in peak_records]
+        print(tabulate(records, stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Record" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Number" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Value" + self.cls['RESET']]))
+
+        speed = stats['computed'] / stats['elapsed']
+        print(tabulate([[stats['numbers'], '{chunks} ({resumed} resumed)'.format(chunks=stats['chunks'], resumed=stats['resumed']),
+                         stats['workers'], stats['reached'], '{speed:.0f}/s'.format(speed=speed),
+                         '{speed:.0f}/s'.format(speed=speed / stats['workers'])]],
+                       stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Numbers" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Chunks" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Workers" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Threshold reached" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Speed" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Per core" + self.cls['RESET']]))
+
+        if stats['lookups']:
+            print(self.cls['GREEN'] + 'Cache hit rate: ' + self.cls['RESET'] + '{rate:.1f}% ({hits} of {lookups} lookups)'.format(
+                rate=stats['hits'] / stats['lookups'] * 100, hits=stats['hits'], lookups=stats['lookups']))
+
+        if out_path is not None:
+            try:
+                # Peaks that do not fit a uint64 are stored as COLLATZ_PEAK_OVERFLOW, like calculate-range does
+                np.savez(out_path, histogram=histogram,
+                         step_records=np.array(step_records, np.uint64).reshape(-1, 2),
+                         peak_records=np.array([[n, min(p, COLLATZ_PEAK_OVERFLOW)] for n, p in peak_records], np.uint64).reshape(-1, 2))
+            except OSError as e:
+                print(self.cls['RED'] + 'Could not store the results: ' + str(e))
+                return
+            print(self.cls['GREEN'] + 'Stored the histogram and records: ' + self.cls['RESET'] + out_path)
+
+    def __open_cache__(self):
+        # Returns the stopping time cache, None when there is none set or False when it cannot be opened
+        path = self.settings['CACHE']['value']
+        if path is None:
+            return None
+
+        try:
+            return CollatzCache(path, self.settings['CACHE_SIZE']['value'])
+        except (OSError, ValueError) as e:
+            print(self.cls['RED'] + 'Could not open the cache: ' + str(e))
+            return False
+
+    def __print_cache__(self, cache):
+        rate = cache.hits / cache.lookups * 100 if cache.lookups else 0
+        print(tabulate([[cache.lookups, cache.hits, '{rate:.1f}%'.format(rate=rate),
+                         '{known} of {size}'.format(known=cache.known(), size=cache.size)]],
+                       stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Cache lookups" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Hits" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Hit rate" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Known numbers" + self.cls['RESET']]))
+
+    def precmd(self, ln):
+        # Commands such as 'calculate-range' are handled by their do_calculate_range counterparts
+        arr = ln.split(' ')
+        arr[0] = arr[0].replace('-', '_')
+        return ' '.join(arr)
+
     def default(self, ln):
         ln = ln.lower()
 
@@ -1,13 +1,78 @@
+import abc
+import asyncio
 import binascii
+import csv
+import io
+import itertools
+import json
+import lzma
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
 from cmd import Cmd
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from tabulate import tabulate
 
-from Crypto.Cipher import AES, DES, DES3, ARC2, CAST, Salsa20
+from Crypto.Cipher import AES, DES, DES3, ARC2, CAST, Salsa20, ChaCha20_Poly1305
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF, PBKDF2, scrypt
 from Crypto.Random import get_random_bytes
 from base64 import b64encode, b64decode
 
 from main import MainPrompt
 
+# Size of the chunks in which files are read, encrypted and written
+CHUNK_SIZE = 1024 * 1024
+
+# Binary envelope layout (all integers are big-endian):
+#   header    magic 'PUTE', version, cipher id, codec id, segment size and the base nonce
+#   segments  ciphertext + tag, all segments except for the last one hold exactly segment size bytes of plaintext
+#   index     per segment its offset in the envelope, its stored length and its plaintext length
+#   footer    offset of the index, amount of segments and magic 'PUTI'
+ENVELOPE_MAGIC = b'PUTE'
+ENVELOPE_INDEX_MAGIC = b'PUTI'
+ENVELOPE_VERSION = 2
+ENVELOPE_HEADER = struct.Struct('>4sBBBI8s')
+ENVELOPE_INDEX_ENTRY = struct.Struct('>QII')
+ENVELOPE_FOOTER = struct.Struct('>QI4s')
+# The (authenticated) ciphers that can be used for the segments of an envelope
+ENVELOPE_CIPHERS = {1: 'AES-GCM', 2: 'ChaCha20-Poly1305'}
+# Compression codecs that can be applied before encryption, every envelope segment is compressed on its own
+CODECS = {0: 'none', 1: 'zlib', 2: 'lzma'}
+# Size of the segments that are encrypted independently of each other
+SEGMENT_SIZE = 4 * 1024 * 1024
+SEGMENT_TAG_SIZE = 16
+# Extension of the envelopes that are written when a directory is encrypted
+ENVELOPE_SUFFIX = '.pute'
+
+# Directory mode: size of the queues between the pipeline stages and the size from which
+# files are streamed instead of being read into memory at once
+TREE_QUEUE_SIZE = 64
+TREE_LARGE_FILE = 16 * 1024 * 1024
+
+# Key derivation parameters for passphrases, both take roughly 100 ms on a modern machine
+KDF_PARAMS = {
+    'scrypt': {'N': 2**15, 'r': 8, 'p': 1},
+    'PBKDF2': {'count': 600000}
+}
+KDF_SALT_SIZE = 16
+# The KDF stretches a passphrase into a master key of this size, every cipher expands its own key from it (HKDF)
+KDF_MASTER_SIZE = 32
+# Derived keys are kept in memory (at most this many, for this many seconds) so a passphrase is only stretched once
+KEY_CACHE_SIZE = 64
+KEY_CACHE_TTL = 15 * 60
+# Random bytes are fetched from the OS in blocks of this size, keys, nonces, salts etc. are sliced from them
+ENTROPY_BLOCK_SIZE = 64 * 1024
+
+# Message sizes used by the 'bench' command (64 B up to 64 MB)
+BENCH_SIZES = [64, 1024, 16 * 1024, 256 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+# Minimum amount of seconds that every cipher/size combination is measured
+BENCH_TIME = 0.25
+
 
 def bytes_to_base64(byte_input):
     return b64encode(byte_input).decode()
@@ -21,6 +86,50 @@ def base64_to_bytes(base64_input):
         return None
 
 
+def strtobool(val):
+    # Replacement for distutils.util.strtobool (distutils is gone as of Python 3.12)
+    val = str(val).lower()
+    if val in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if val in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError('invalid truth value ' + repr(val))
+
+
+def get_flag(cls, name, value):
+    # Parse a yes/no setting, None (after an error message) if it is invalid. This and the helpers below are
+    # shared by the prompts of the modules that have the same settings.
+    try:
+        return strtobool(value)
+    except ValueError:
+        print(cls['RED'] + name + ' must be either \'yes\' or \'no\'.')
+        return None
+
+
+def get_workers(cls, value):
+    # None means that the pool uses all of the available cores, 0 means the setting is invalid
+    if value is None:
+        return None
+
+    try:
+        workers = int(value)
+        if workers < 1:
+            raise ValueError()
+    except ValueError:
+        print(cls['RED'] + 'WORKERS must be a number that is greater than 0.')
+        return 0
+
+    return workers
+
+
+def print_progress(stats):
+    # Progress callback for process_tree, the final call (with 'elapsed' set) ends the line
+    elapsed = max(time.perf_counter() - stats['start'], 1e-9)
+    print('\r{files} files, {size:.1f} MB, {speed:.1f} MB/s, {errors} errors'.format(
+        files=stats['files'], size=stats['bytes'] / 1e6, speed=stats['bytes'] / 1e6 / elapsed, errors=stats['errors']),
+        end='\n' if 'elapsed' in stats else '', flush=True)
+
+
 def is_valid_byte(req, bt):
     # Decode to (hopefully) bytes
     bt = base64_to_bytes(bt)
@@ -33,6 +142,1132 @@ def is_valid_byte(req, bt):
     return len(bt) == req
 
 
+class EntropyPool(object):
+    # Serves random bytes from a buffered block of OS randomness, so generating many small values
+    # (keys, nonces, salts, password characters) does not cost a system call each.
+    # Every byte is handed out once, a new block is allocated when the current one runs out
+    # (so views that were handed out earlier stay valid). Safe to share between threads, a forked
+    # child process throws the inherited block away so it never repeats the parent's bytes.
+    def __init__(self, block_size=ENTROPY_BLOCK_SIZE):
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.served = 0
+        self.refills = 0
+        self.reset()
+
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        # Drop the buffered bytes (a lock that was held during a fork is replaced as well)
+        self.lock = threading.Lock()
+        self.block = memoryview(b'')
+        self.pos = 0
+        self.pid = os.getpid()
+
+    def get_view(self, n):
+        # Return n random bytes as a (read-only, zero-copy) memoryview
+        with self.lock:
+            if self.pid != os.getpid():
+                self.block = memoryview(b'')
+                self.pos = 0
+                self.pid = os.getpid()
+
+            self.served += n
+            # Large requests skip the pool
+            if n > self.block_size:
+                self.refills += 1
+                return memoryview(get_random_bytes(n))
+
+            if self.pos + n > len(self.block):
+                self.block = memoryview(get_random_bytes(self.block_size))
+                self.pos = 0
+                self.refills += 1
+
+            view = self.block[self.pos:self.pos + n]
+            self.pos += n
+            return view
+
+    def get_bytes(self, n):
+        return self.get_view(n).tobytes()
+
+    def randbelow(self, n):
+        # Return a uniformly distributed integer in [0, n), values that would make
+        # the modulo biased are rejected and drawn again
+        if n <= 0:
+            raise ValueError('n must be positive')
+        if n == 1:
+            return 0
+
+        size = ((n - 1).bit_length() + 7) // 8
+        limit = (256 ** size // n) * n
+        while 1:
+            value = int.from_bytes(self.get_view(size), 'big')
+            if value < limit:
+                return value % n
+
+    def choice(self, seq):
+        return seq[self.randbelow(len(seq))]
+
+    def choices(self, seq, k):
+        # Pick k elements with replacement
+        return [seq[self.randbelow(len(seq))] for _ in range(k)]
+
+    def shuffle(self, lst):
+        # Fisher-Yates shuffle (in place)
+        for i in range(len(lst) - 1, 0, -1):
+            j = self.randbelow(i + 1)
+            lst[i], lst[j] = lst[j], lst[i]
+
+
+# The pool that is shared by all modules
+ENTROPY = EntropyPool()
+
+
+def gen_des3_key():
+    # So why do we do this?
+    # Well according to the documentation this must be done to
+    # ~ stop Triple DES from degrading to Single DES
+    while 1:
+        try:
+            # Set the bits in a TDES key (des3_key to prevent shadowing)
+            des3_key = DES3.adjust_key_parity(ENTROPY.get_bytes(24))
+            break
+        except ValueError:
+            pass
+
+    # Finally, return the key
+    return des3_key
+
+
+class CipherEngine(abc.ABC):
+    # Describes a cipher: its key, nonce and iv sizes and how its cipher objects are created.
+    # Subclasses only have to implement new(), everything else is shared.
+    name = None
+    kind = 'Block'
+    key_size = None
+    # None means the cipher does not use a nonce/iv/mac
+    nonce_size = None
+    iv_size = None
+    mac_size = None
+    # Amount of bytes in front of the ciphertext that the cipher writes itself (an encrypted iv e.g)
+    prefix_size = 0
+    # Whether or not a configured NONCE is used for encryption, otherwise a new one is generated every time
+    nonce_setting = False
+
+    def new_key(self):
+        return ENTROPY.get_bytes(self.key_size)
+
+    def adjust_key(self, key):
+        # Turn arbitrary bytes of the right length (from a KDF e.g) into a valid key
+        return key
+
+    def is_valid_key(self, key):
+        return type(key) == bytes and len(key) == self.key_size
+
+    @abc.abstractmethod
+    def new(self, key, nonce, iv):
+        # Create the (pycryptodome) cipher object
+        pass
+
+    def encryptor(self, key, nonce=None, iv=None):
+        # Return a cipher object with encrypt() (and digest() for authenticated ciphers),
+        # a nonce or iv that is left empty is taken from the entropy pool
+        if nonce is None and self.nonce_size is not None:
+            nonce = ENTROPY.get_bytes(self.nonce_size)
+        if iv is None and self.iv_size is not None:
+            iv = ENTROPY.get_bytes(self.iv_size)
+
+        return self.new(key, nonce, iv)
+
+    def decryptor(self, key, nonce=None, iv=None):
+        # Return a cipher object with decrypt() (and verify() for authenticated ciphers)
+        return self.new(key, nonce, iv)
+
+    def flush(self, cip, decrypt=False):
+        # Return the output that a cipher object still holds back at the end of a stream
+        return b''
+
+    def params(self, cip):
+        # The values (besides the key) that are needed to decrypt the output of the given cipher object
+        return {
+            'nonce': cip.nonce if self.nonce_size is not None else None,
+            'iv': cip.iv if self.iv_size is not None and not self.prefix_size else None,
+            'mac': cip.digest() if self.mac_size is not None else None
+        }
+
+    def encrypt(self, key, data, nonce=None, iv=None):
+        # One-shot encryption, returns the ciphertext and the parameters
+        cip = self.encryptor(key, nonce=nonce, iv=iv)
+        ciptext = cip.encrypt(data) + self.flush(cip)
+        return ciptext, self.params(cip)
+
+    def decrypt(self, key, data, nonce=None, iv=None, mac=None):
+        # One-shot decryption, raises a ValueError if the data could not be authenticated
+        if self.prefix_size:
+            iv, data = data[:self.prefix_size], data[self.prefix_size:]
+
+        cip = self.decryptor(key, nonce=nonce, iv=iv)
+        if self.mac_size is not None:
+            if mac is None:
+                raise ValueError('MAC check failed')
+            return cip.decrypt_and_verify(data, mac)
+
+        return cip.decrypt(data)
+
+
+class AESEngine(CipherEngine):
+    name = 'AES'
+    key_size = 16
+    nonce_size = 15
+    mac_size = 16
+    nonce_setting = True
+
+    def new(self, key, nonce, iv):
+        return AES.new(key, AES.MODE_EAX, nonce=nonce)
+
+
+class DESEngine(CipherEngine):
+    name = 'Single-DES'
+    key_size = 8
+    iv_size = 8
+
+    def new(self, key, nonce, iv):
+        return DES.new(key, DES.MODE_OFB, iv=iv)
+
+
+class DES3Engine(CipherEngine):
+    name = 'Triple-DES'
+    key_size = 24
+    iv_size = 8
+
+    def new_key(self):
+        return gen_des3_key()
+
+    def adjust_key(self, key):
+        # Raises a ValueError in the (very unlikely) case that the key degrades to Single DES
+        return DES3.adjust_key_parity(key)
+
+    def new(self, key, nonce, iv):
+        return DES3.new(key, DES3.MODE_CFB, iv=iv)
+
+
+class RC2Engine(CipherEngine):
+    name = 'RC2'
+    key_size = 16
+    iv_size = 8
+
+    def new(self, key, nonce, iv):
+        return ARC2.new(key, ARC2.MODE_CFB, iv=iv)
+
+
+class CASTEngine(CipherEngine):
+    name = 'CAST-128'
+    key_size = 16
+    iv_size = 8
+    # So the iv must be 10 bytes long for decryption (8 for encryption)
+    # and the iv is encrypted and prefixed to the ciphertext
+    prefix_size = 8 + 2
+
+    def new(self, key, nonce, iv):
+        return CAST.new(key, CAST.MODE_OPENPGP, iv=iv)
+
+
+class Salsa20Engine(CipherEngine):
+    name = 'Salsa20'
+    kind = 'Stream'
+    key_size = 32
+    nonce_size = 8
+
+    def new(self, key, nonce, iv):
+        return Salsa20.new(key, nonce=nonce)
+
+
+# The authenticated ciphers below only need a single pass over the data (AES-EAX needs two), on hardware
+# with AES instructions or for ChaCha20 on hardware without them they are the fastest ones available
+class AESGCMEngine(CipherEngine):
+    name = 'AES-GCM'
+    key_size = 16
+    nonce_size = 12
+    mac_size = 16
+
+    def new(self, key, nonce, iv):
+        return AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=self.mac_size)
+
+
+class AESOCBEngine(CipherEngine):
+    name = 'AES-OCB'
+    key_size = 16
+    nonce_size = 15
+    mac_size = 16
+
+    def new(self, key, nonce, iv):
+        return AES.new(key, AES.MODE_OCB, nonce=nonce, mac_len=self.mac_size)
+
+    def flush(self, cip, decrypt=False):
+        # OCB holds back the last (partial) block until it is told that there is no more data
+        return cip.decrypt() if decrypt else cip.encrypt()
+
+
+class ChaCha20Poly1305Engine(CipherEngine):
+    name = 'ChaCha20-Poly1305'
+    kind = 'Stream'
+    key_size = 32
+    nonce_size = 12
+    mac_size = 16
+
+    def new(self, key, nonce, iv):
+        return ChaCha20_Poly1305.new(key=key, nonce=nonce)
+
+
+# All available ciphers by name (the CIPHER setting)
+CIPHERS = {}
+
+
+def register_cipher(engine):
+    CIPHERS[engine.name] = engine
+    return engine
+
+
+def get_cipher(cph):
+    # Look up a cipher engine by name, raises a ValueError for unknown ciphers
+    try:
+        return CIPHERS[cph]
+    except KeyError:
+        raise ValueError('Invalid cipher: ' + str(cph))
+
+
+for engine_cls in [AESEngine, DESEngine, DES3Engine, RC2Engine, CASTEngine, Salsa20Engine,
+                   AESGCMEngine, AESOCBEngine, ChaCha20Poly1305Engine]:
+    register_cipher(engine_cls())
+
+
+class KeyCache(object):
+    # A small in-memory LRU cache for keys that were derived from a passphrase, entries expire after ttl seconds.
+    # Cache keys hold a digest of the passphrase instead of the passphrase itself.
+    def __init__(self, max_size=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, cache_key):
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                # Mark the entry as the most recently used one
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self.entries[cache_key]
+            self.misses += 1
+            return None
+
+    def put(self, cache_key, key):
+        with self.lock:
+            self.entries[cache_key] = (key, time.monotonic())
+            self.entries.move_to_end(cache_key)
+
+            # Evict the least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+# The cache that is shared by the prompt and the functions below
+KEY_CACHE = KeyCache()
+
+
+def derive_key(passphrase, salt, key_len, purpose, kdf='scrypt', cache=KEY_CACHE):
+    # Stretch a passphrase (str or bytes) into a key of key_len bytes for the given purpose (the cipher name).
+    # The passphrase is stretched into a master key and the key is expanded from that with the purpose as
+    # context, that way the keys of two ciphers are unrelated even when the passphrase and salt are the same.
+    # Repeated calls with the same arguments are served from the cache (pass cache=None to skip it).
+    if kdf not in KDF_PARAMS:
+        raise ValueError('Invalid KDF: ' + str(kdf))
+
+    if isinstance(passphrase, str):
+        passphrase = passphrase.encode()
+
+    params = KDF_PARAMS[kdf]
+    cache_key = (SHA256.new(passphrase).digest(), salt, kdf, tuple(sorted(params.items())), purpose, key_len)
+
+    if cache is not None:
+        key = cache.get(cache_key)
+        if key is not None:
+            return key
+
+    if kdf == 'scrypt':
+        master = scrypt(passphrase, salt, KDF_MASTER_SIZE, **params)
+    else:
+        master = PBKDF2(passphrase, salt, KDF_MASTER_SIZE, hmac_hash_module=SHA256, **params)
+    key = HKDF(master, key_len, salt, SHA256, context=purpose.encode())
+
+    if cache is not None:
+        cache.put(cache_key, key)
+
+    return key
+
+
+def codec_id(codec):
+    # The id under which a codec is stored in envelope headers and encrypted files
+    for i, name in CODECS.items():
+        if name == codec:
+            return i
+    raise ValueError('Invalid codec: ' + str(codec))
+
+
+def compress(codec, data, level=None):
+    # One-shot compression, the level is the zlib level (0-9) or the lzma preset (0-9), None for the default
+    if codec == 'zlib':
+        return zlib.compress(data, level if level is not None else zlib.Z_DEFAULT_COMPRESSION)
+    elif codec == 'lzma':
+        return lzma.compress(data, preset=level)
+    elif codec == 'none':
+        return data
+
+    raise ValueError('Invalid codec: ' + str(codec))
+
+
+def decompress(codec, data, max_length=-1):
+    # One-shot decompression that never produces more than max_length bytes (so it cannot blow up memory)
+    if codec == 'zlib':
+        d = zlib.decompressobj()
+    elif codec == 'lzma':
+        d = lzma.LZMADecompressor()
+    elif codec == 'none':
+        return data
+    else:
+        raise ValueError('Invalid codec: ' + str(codec))
+
+    try:
+        # zlib takes 0 for no limit, lzma -1
+        txt = d.decompress(data, max(max_length, 0) if codec == 'zlib' else max_length)
+    except (zlib.error, lzma.LZMAError):
+        raise ValueError('The compressed data is corrupt')
+
+    if not d.eof:
+        raise ValueError('The compressed data is truncated or too long')
+    return txt
+
+
+def new_compressor(codec, level=None):
+    # Streaming compressor with compress() and flush(), None if no compression is used
+    if codec == 'zlib':
+        return zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION)
+    elif codec == 'lzma':
+        return lzma.LZMACompressor(preset=level)
+    elif codec == 'none':
+        return None
+
+    raise ValueError('Invalid codec: ' + str(codec))
+
+
+def iter_decompressed(codec, chunks, max_length=CHUNK_SIZE):
+    # Streaming decompression of an iterable of chunks, no piece that is yielded is bigger than max_length
+    try:
+        if codec == 'zlib':
+            d = zlib.decompressobj()
+            for chunk in chunks:
+                while chunk:
+                    yield d.decompress(chunk, max_length)
+                    chunk = d.unconsumed_tail
+            yield d.flush()
+        elif codec == 'lzma':
+            d = lzma.LZMADecompressor()
+            for chunk in chunks:
+                # lzma refuses any input after the end of the stream, even empty input
+                if d.eof:
+                    if len(chunk):
+                        raise ValueError('The compressed data is followed by garbage')
+                    continue
+
+                yield d.decompress(chunk, max_length)
+                while not d.needs_input and not d.eof:
+                    yield d.decompress(b'', max_length)
+        elif codec == 'none':
+            yield from chunks
+            return
+        else:
+            raise ValueError('Invalid codec: ' + str(codec))
+    except (zlib.error, lzma.LZMAError):
+        raise ValueError('The compressed data is corrupt')
+
+    if not d.eof:
+        raise ValueError('The compressed data is truncated')
+
+
+def iter_file_chunks(path, chunk_size=CHUNK_SIZE, use_mmap=False, offset=0):
+    # Yield the contents of a file as memoryviews of at most chunk_size bytes, memory usage stays the same
+    # no matter how big the file is. Every chunk is only valid until the next one is requested.
+    with open(path, 'rb') as f:
+        if use_mmap:
+            size = os.fstat(f.fileno()).st_size
+
+            # An empty file cannot be mapped
+            if size <= offset:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    for pos in range(offset, size, chunk_size):
+                        # The slice is released once the consumer asks for the next chunk, that way the map can be closed
+                        with view[pos:pos + chunk_size] as chunk:
+                            yield chunk
+                finally:
+                    view.release()
+        else:
+            f.seek(offset)
+
+            # Read into the same buffer over and over again instead of allocating a new bytes object per chunk
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                yield view[:n]
+
+
+def encrypt_file(cph, key, in_path, out_path, nonce=None, chunk_size=CHUNK_SIZE, use_mmap=False, codec='none', level=None):
+    engine = get_cipher(cph)
+    cip = engine.encryptor(key, nonce=nonce)
+    # The data is compressed before it is encrypted (encrypted data does not compress)
+    comp = new_compressor(codec, level)
+
+    with open(out_path, 'wb') as out:
+        # CAST-128 (OpenPGP) prefixes the output with the encrypted IV on the first call,
+        # by doing an empty call first this also happens for empty files
+        out.write(cip.encrypt(b''))
+        # The first byte of the plaintext is the codec, that way decryption knows how to decompress the rest
+        out.write(cip.encrypt(bytes([codec_id(codec)])))
+
+        for chunk in iter_file_chunks(in_path, chunk_size, use_mmap):
+            out.write(cip.encrypt(chunk if comp is None else comp.compress(chunk)))
+
+        if comp is not None:
+            out.write(cip.encrypt(comp.flush()))
+        out.write(engine.flush(cip))
+
+    # Return the values that are needed for decryption
+    return engine.params(cip)
+
+
+def __split_codec__(chunks):
+    # Take the codec byte off the front of the decrypted chunks, returns the codec and the remaining chunks
+    for chunk in chunks:
+        if len(chunk):
+            if chunk[0] not in CODECS:
+                # Without a mac this is where a wrong key shows
+                raise ValueError('Unknown codec, the key is most likely wrong')
+            return CODECS[chunk[0]], itertools.chain([chunk[1:]], chunks)
+
+    raise ValueError('The file is truncated')
+
+
+def decrypt_file(cph, key, in_path, out_path, nonce=None, iv=None, mac=None, chunk_size=CHUNK_SIZE, use_mmap=False):
+    # Decrypt (and decompress) a file written by encrypt_file, returns the codec it was compressed with
+    engine = get_cipher(cph)
+
+    if engine.prefix_size:
+        # The (encrypted) iv is prefixed to the file, so we read it separately
+        with open(in_path, 'rb') as f:
+            iv = f.read(engine.prefix_size)
+
+    cip = engine.decryptor(key, nonce=nonce, iv=iv)
+
+    def decrypted():
+        for chunk in iter_file_chunks(in_path, chunk_size, use_mmap, engine.prefix_size):
+            yield cip.decrypt(chunk)
+        yield engine.flush(cip, decrypt=True)
+
+    try:
+        with open(out_path, 'wb') as out:
+            codec, chunks = __split_codec__(decrypted())
+            for txt in iter_decompressed(codec, chunks, chunk_size):
+                out.write(txt)
+    except ValueError:
+        # Most likely the wrong key (or codec) was used
+        os.remove(out_path)
+        raise
+
+    if engine.mac_size is not None:
+        try:
+            # The mac can only be verified once everything has been decrypted
+            cip.verify(mac)
+        except (ValueError, TypeError):
+            # Do not leave unauthenticated plaintext behind
+            os.remove(out_path)
+            raise ValueError('MAC check failed')
+
+    return codec
+
+
+def benchmark_cipher(engine, data, min_time=BENCH_TIME):
+    # Encrypt the data as one message over and over again (setting up the cipher included, like a real message)
+    # for at least min_time seconds, returns the throughput in MB/s and the latency per message in seconds
+    key = engine.new_key()
+    count = 0
+
+    start = time.perf_counter()
+    while True:
+        engine.encrypt(key, data)
+        count += 1
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+
+    return len(data) * count / 1e6 / elapsed, elapsed / count
+
+
+def format_size(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024 or unit == 'MB':
+            return '{size:g} {unit}'.format(size=size, unit=unit)
+        size /= 1024
+
+
+def format_duration(seconds):
+    if seconds < 1e-3:
+        return '{t:.1f} µs'.format(t=seconds * 1e6)
+    elif seconds < 1:
+        return '{t:.1f} ms'.format(t=seconds * 1e3)
+    return '{t:.2f} s'.format(t=seconds)
+
+
+def read_records(path, field='text'):
+    # Yield (record, text) pairs from a JSONL or CSV file, the record holds all the other fields (like an id)
+    # so they can be written next to the result. A JSONL line may also be a plain string.
+    with open(path, 'r', newline='') as f:
+        if path.lower().endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row, row.pop(field)
+        else:
+            for ln in f:
+                if not ln.strip():
+                    continue
+
+                record = json.loads(ln)
+                record, txt = (record, record.pop(field)) if isinstance(record, dict) else ({}, record)
+                if not isinstance(txt, str):
+                    raise ValueError('The {field} of a record must be a string'.format(field=field))
+                yield record, txt
+
+
+def __get_batch_engine__(cph, key):
+    engine = get_cipher(cph)
+    if not engine.is_valid_key(key):
+        raise ValueError('The key must be {size} bytes long'.format(size=engine.key_size))
+    return engine
+
+
+def encrypt_records(cph, key, texts):
+    # Encrypt every text (str or bytes) separately and yield (nonce, iv, tag, ciphertext) tuples,
+    # values that are not used by the cipher are None
+    # The engine is looked up and the key is validated once for the whole batch instead of once per record
+    engine = __get_batch_engine__(cph, key)
+
+    for txt in texts:
+        if isinstance(txt, str):
+            txt = txt.encode()
+
+        ciptext, params = engine.encrypt(key, txt)
+        yield params['nonce'], params['iv'], params['mac'], ciptext
+
+
+def decrypt_records(cph, key, records):
+    # The reverse of encrypt_records, takes (nonce, iv, tag, ciphertext) tuples and yields the plaintexts
+    engine = __get_batch_engine__(cph, key)
+
+    for nonce, iv, tag, ciptext in records:
+        yield engine.decrypt(key, ciptext, nonce=nonce, iv=iv, mac=tag)
+
+
+def encrypt_batch(cph, key, in_path, out_path, field='text'):
+    # Encrypt all records of a JSONL/CSV file into a JSONL file with base64 nonce/iv/tag/ciphertext fields,
+    # an incomplete OUTPUT is removed if a record cannot be read or encrypted
+    engine = __get_batch_engine__(cph, key)
+    count = 0
+
+    try:
+        with open(out_path, 'w', buffering=CHUNK_SIZE) as out:
+            for record, txt in read_records(in_path, field):
+                ciptext, params = engine.encrypt(key, txt.encode())
+                for name, value in [('nonce', params['nonce']), ('iv', params['iv']), ('tag', params['mac']), ('ciphertext', ciptext)]:
+                    if value is not None:
+                        record[name] = bytes_to_base64(value)
+
+                out.write(json.dumps(record) + '\n')
+                count += 1
+    except (KeyError, ValueError):
+        os.remove(out_path)
+        raise
+
+    return count
+
+
+def decrypt_batch(cph, key, in_path, out_path, field='text'):
+    # Decrypt a JSONL file created by encrypt_batch, the plaintext is written to the configured field again
+    engine = __get_batch_engine__(cph, key)
+    count = 0
+
+    try:
+        with open(out_path, 'w', buffering=CHUNK_SIZE) as out:
+            for record, ciptext in read_records(in_path, 'ciphertext'):
+                nonce, iv, tag = [record.pop(name, None) for name in ['nonce', 'iv', 'tag']]
+                txt = engine.decrypt(key, base64_to_bytes(ciptext), nonce=nonce if nonce is None else base64_to_bytes(nonce),
+                                     iv=iv if iv is None else base64_to_bytes(iv), mac=tag if tag is None else base64_to_bytes(tag))
+                record[field] = txt.decode()
+
+                out.write(json.dumps(record) + '\n')
+                count += 1
+    except (KeyError, TypeError, ValueError):
+        os.remove(out_path)
+        raise
+
+    return count
+
+
+def __segment_cipher__(header, key, index, last):
+    # Every segment gets its own nonce (base nonce + segment number). The header, the number and whether or not
+    # this is the last segment are authenticated as well, so segments cannot be reordered, swapped or cut off
+    nonce = header[-8:] + struct.pack('>I', index)
+
+    if header[5] not in ENVELOPE_CIPHERS:
+        raise ValueError('Unsupported envelope cipher')
+
+    cip = CIPHERS[ENVELOPE_CIPHERS[header[5]]].encryptor(key, nonce=nonce)
+    cip.update(header)
+    cip.update(struct.pack('>I?', index, last))
+    return cip
+
+
+def seal_segment(header, key, index, last, data, level=None):
+    # Compress (if the header says so) and encrypt a segment, the tag is appended to the ciphertext
+    ciptext, tag = __segment_cipher__(header, key, index, last).encrypt_and_digest(compress(CODECS[header[6]], data, level))
+    return ciptext + tag
+
+
+def open_segment(header, key, index, last, data):
+    if len(data) < SEGMENT_TAG_SIZE:
+        raise ValueError('Segment {index} is truncated'.format(index=index))
+
+    try:
+        txt = __segment_cipher__(header, key, index, last).decrypt_and_verify(data[:-SEGMENT_TAG_SIZE], data[-SEGMENT_TAG_SIZE:])
+    except ValueError:
+        raise ValueError('MAC check failed for segment {index}'.format(index=index))
+
+    # A segment never holds more than segment size bytes of plaintext, the extra byte lets the
+    # decompressor reach the end of the stream (longer segments are caught by the length check)
+    return decompress(CODECS[header[6]], txt, ENVELOPE_HEADER.unpack(header)[4] + 1)
+
+
+def new_envelope_header(segment_size=SEGMENT_SIZE, cipher_id=1, codec='none'):
+    if cipher_id not in ENVELOPE_CIPHERS:
+        raise ValueError('Unsupported envelope cipher')
+
+    return ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, cipher_id, codec_id(codec), segment_size, ENTROPY.get_bytes(8))
+
+
+def pack_envelope(key, data, segment_size=SEGMENT_SIZE, cipher_id=1, codec='none', level=None):
+    # The binary counterpart of bytes_to_base64(cip.encrypt(...)), the nonce and tags are stored inside of it
+    header = new_envelope_header(segment_size, cipher_id, codec)
+    count = max(1, -(-len(data) // segment_size))
+    view = memoryview(data)
+
+    out = bytearray(header)
+    index = bytearray()
+    for i in range(count):
+        segment = view[i * segment_size:(i + 1) * segment_size]
+        sealed = seal_segment(header, key, i, i == count - 1, segment, level)
+        index += ENVELOPE_INDEX_ENTRY.pack(len(out), len(sealed), len(segment))
+        out += sealed
+
+    out += index + ENVELOPE_FOOTER.pack(len(out), count, ENVELOPE_INDEX_MAGIC)
+    return bytes(out)
+
+
+def unpack_envelope(key, envelope):
+    return decrypt_range(key, io.BytesIO(envelope))
+
+
+def read_envelope_header(f):
+    # Read and check the header of an envelope (file object), returns the raw header and its fields
+    f.seek(0)
+    header = f.read(ENVELOPE_HEADER.size)
+    if len(header) != ENVELOPE_HEADER.size:
+        raise ValueError('Not an envelope')
+
+    fields = ENVELOPE_HEADER.unpack(header)
+    magic, version, cipher_id, codec_id, segment_size, _nonce = fields
+    if magic != ENVELOPE_MAGIC or version != ENVELOPE_VERSION or segment_size < 1:
+        raise ValueError('Not an envelope')
+    if cipher_id not in ENVELOPE_CIPHERS:
+        raise ValueError('Unsupported envelope cipher')
+    if codec_id not in CODECS:
+        raise ValueError('Unsupported envelope codec')
+
+    return header, fields
+
+
+def read_envelope_index(f):
+    # Read the header and the trailing index of an envelope (file object), returns the header,
+    # the segment size and a list with an (offset, stored length, plaintext length) tuple per segment
+    header, fields = read_envelope_header(f)
+    segment_size = fields[4]
+
+    size = f.seek(0, os.SEEK_END)
+    if size < ENVELOPE_HEADER.size + ENVELOPE_FOOTER.size:
+        raise ValueError('The envelope is truncated')
+
+    f.seek(size - ENVELOPE_FOOTER.size)
+    index_offset, count, magic = ENVELOPE_FOOTER.unpack(f.read(ENVELOPE_FOOTER.size))
+    if magic != ENVELOPE_INDEX_MAGIC or count < 1 or index_offset + count * ENVELOPE_INDEX_ENTRY.size + ENVELOPE_FOOTER.size != size:
+        raise ValueError('The envelope index is corrupt')
+
+    f.seek(index_offset)
+    entries = list(ENVELOPE_INDEX_ENTRY.iter_unpack(f.read(count * ENVELOPE_INDEX_ENTRY.size)))
+
+    return header, segment_size, entries
+
+
+def __check_segment__(txt, index, last, plain, segment_size):
+    # All segments except for the last one must be full, otherwise the plaintext offsets would be wrong
+    if len(txt) != plain or (not last and len(txt) != segment_size):
+        raise ValueError('Segment {index} has an invalid length'.format(index=index))
+    return txt
+
+
+def decrypt_range(key, source, start=0, length=None):
+    # Decrypt (and verify) only the segments that overlap with the byte range [start, start + length)
+    # of the plaintext, the source may be a path or a seekable file object
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as f:
+            return decrypt_range(key, f, start, length)
+
+    header, segment_size, entries = read_envelope_index(source)
+    total = (len(entries) - 1) * segment_size + entries[-1][2]
+
+    if start < 0 or (length is not None and length < 0):
+        raise ValueError('The range cannot be negative')
+
+    end = total if length is None else min(start + length, total)
+    if start >= end:
+        return b''
+
+    out = bytearray()
+    for i in range(start // segment_size, (end - 1) // segment_size + 1):
+        offset, stored, plain = entries[i]
+        last = i == len(entries) - 1
+
+        source.seek(offset)
+        txt = __check_segment__(open_segment(header, key, i, last, source.read(stored)), i, last, plain, segment_size)
+
+        seg_start = i * segment_size
+        out += txt[max(start - seg_start, 0):end - seg_start]
+
+    return bytes(out)
+
+
+def encrypt_envelope_file(key, in_path, out_path, segment_size=SEGMENT_SIZE, cipher_id=1, codec='none', level=None):
+    # Single-process, streaming version of encrypt_file_parallel (only one segment is in memory at a time)
+    header = new_envelope_header(segment_size, cipher_id, codec)
+    count = max(1, -(-os.path.getsize(in_path) // segment_size))
+
+    index = bytearray()
+    with open(in_path, 'rb') as f, open(out_path, 'wb') as out:
+        out.write(header)
+
+        for i in range(count):
+            segment = f.read(segment_size)
+            sealed = seal_segment(header, key, i, i == count - 1, segment, level)
+            index += ENVELOPE_INDEX_ENTRY.pack(out.tell(), len(sealed), len(segment))
+            out.write(sealed)
+
+        out.write(index + ENVELOPE_FOOTER.pack(out.tell(), count, ENVELOPE_INDEX_MAGIC))
+
+
+def decrypt_envelope_file(key, in_path, out_path):
+    # Single-process, streaming version of decrypt_file_parallel
+    try:
+        with open(in_path, 'rb') as f, open(out_path, 'wb') as out:
+            header, segment_size, entries = read_envelope_index(f)
+
+            for i, (offset, stored, plain) in enumerate(entries):
+                last = i == len(entries) - 1
+                f.seek(offset)
+                out.write(__check_segment__(open_segment(header, key, i, last, f.read(stored)), i, last, plain, segment_size))
+    except ValueError:
+        # Do not leave unauthenticated plaintext behind
+        os.remove(out_path)
+        raise
+
+
+def __encrypt_segment__(task):
+    header, key, in_path, out_path, index, last, in_offset, length, out_offset, level = task
+
+    with open(in_path, 'rb') as f:
+        f.seek(in_offset)
+        sealed = seal_segment(header, key, index, last, f.read(length), level)
+
+    # Compressed segments do not have a known position, so those are returned to the parent
+    if out_offset is None:
+        return sealed
+
+    # Each worker writes its own part of the (preallocated) output file, so no data has to go back to the parent
+    with open(out_path, 'r+b') as f:
+        f.seek(out_offset)
+        f.write(sealed)
+
+
+def __decrypt_segment__(task):
+    header, key, in_path, out_path, index, last, offset, stored, plain, segment_size = task
+
+    with open(in_path, 'rb') as f:
+        f.seek(offset)
+        txt = open_segment(header, key, index, last, f.read(stored))
+
+    with open(out_path, 'r+b') as f:
+        f.seek(index * segment_size)
+        f.write(__check_segment__(txt, index, last, plain, segment_size))
+
+
+def __run_segments__(fn, tasks, out_path, out_size, workers):
+    # Create (or empty) the output file and give it its final size so the workers can write anywhere in it
+    with open(out_path, 'wb') as f:
+        f.truncate(out_size)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # Consume the results so that exceptions from the workers are raised here
+            for _ in pool.map(fn, tasks):
+                pass
+    except Exception:
+        os.remove(out_path)
+        raise
+
+
+def __encrypt_compressed__(tasks, out_path, header, workers):
+    # The workers compress and encrypt, the parent writes the segments in order. Only a limited
+    # amount of segments is in flight at once so memory usage does not depend on the file size.
+    index = bytearray()
+
+    try:
+        with open(out_path, 'wb') as out, ProcessPoolExecutor(max_workers=workers) as pool:
+            out.write(header)
+
+            pending = deque()
+            window = 2 * (workers or os.cpu_count() or 1)
+            tasks = iter(tasks)
+            while True:
+                for task in tasks:
+                    pending.append((task[7], pool.submit(__encrypt_segment__, task)))
+                    if len(pending) >= window:
+                        break
+
+                if not pending:
+                    break
+
+                length, future = pending.popleft()
+                sealed = future.result()
+                index += ENVELOPE_INDEX_ENTRY.pack(out.tell(), len(sealed), length)
+                out.write(sealed)
+
+            out.write(index + ENVELOPE_FOOTER.pack(out.tell(), len(index) // ENVELOPE_INDEX_ENTRY.size, ENVELOPE_INDEX_MAGIC))
+    except Exception:
+        os.remove(out_path)
+        raise
+
+
+def encrypt_file_parallel(key, in_path, out_path, segment_size=SEGMENT_SIZE, workers=None, cipher_id=1, codec='none', level=None):
+    # Split the file into segments that are encrypted with AES-GCM (counter mode + GHASH) or ChaCha20-Poly1305
+    # on a process pool, the result is an envelope so it can also be decrypted in parallel or in parts
+    size = os.path.getsize(in_path)
+    count = max(1, -(-size // segment_size))
+    header = new_envelope_header(segment_size, cipher_id, codec)
+
+    tasks = []
+    index = bytearray()
+    for i in range(count):
+        length = min(segment_size, size - i * segment_size)
+        offset = None if codec != 'none' else ENVELOPE_HEADER.size + i * (segment_size + SEGMENT_TAG_SIZE)
+        tasks.append((header, key, in_path, out_path, i, i == count - 1, i * segment_size, length, offset, level))
+        if offset is not None:
+            index += ENVELOPE_INDEX_ENTRY.pack(offset, length + SEGMENT_TAG_SIZE, length)
+
+    if codec != 'none':
+        __encrypt_compressed__(tasks, out_path, header, workers)
+        return
+
+    index_offset = ENVELOPE_HEADER.size + size + count * SEGMENT_TAG_SIZE
+    __run_segments__(__encrypt_segment__, tasks, out_path, index_offset, workers)
+
+    with open(out_path, 'r+b') as f:
+        f.write(header)
+        f.seek(index_offset)
+        f.write(index + ENVELOPE_FOOTER.pack(index_offset, count, ENVELOPE_INDEX_MAGIC))
+
+
+def decrypt_file_parallel(key, in_path, out_path, workers=None):
+    with open(in_path, 'rb') as f:
+        header, segment_size, entries = read_envelope_index(f)
+
+    tasks = [(header, key, in_path, out_path, i, i == len(entries) - 1, offset, stored, plain, segment_size)
+             for i, (offset, stored, plain) in enumerate(entries)]
+    __run_segments__(__decrypt_segment__, tasks, out_path, (len(entries) - 1) * segment_size + entries[-1][2], workers)
+
+
+def __read_bytes__(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def __process_tree__(root, work, concurrency, queue_size, large_file, progress, interval, skip):
+    loop = asyncio.get_running_loop()
+    # Paths that still have to be read and files that still have to be processed, both queues are bounded
+    # so the walker and the readers wait (backpressure) when the workers cannot keep up
+    paths = asyncio.Queue(queue_size)
+    files = asyncio.Queue(queue_size)
+
+    results = {}
+    stats = {'files': 0, 'bytes': 0, 'errors': 0, 'start': time.perf_counter()}
+
+    # Reads (and the directory walk) go to one pool and the cipher/hash work to the other,
+    # pycryptodome and hashlib release the GIL so threads can use all cores
+    with ThreadPoolExecutor(concurrency) as io_pool, ThreadPoolExecutor(concurrency) as cpu_pool:
+        async def walker():
+            # Directories that cannot be listed are reported like files that cannot be read
+            failed = []
+            walk = os.walk(root, onerror=failed.append)
+            while True:
+                # Every step of the walk blocks on the disk, so it is done in a thread as well
+                step = await loop.run_in_executor(io_pool, next, walk, None)
+                for e in failed:
+                    results[os.path.relpath(e.filename, root) if e.filename else '.'] = e
+                    stats['errors'] += 1
+                failed.clear()
+                if step is None:
+                    break
+
+                # The walk is lazy, an output directory below root would otherwise be walked (and processed) as well
+                step[1][:] = [d for d in step[1] if os.path.abspath(os.path.join(step[0], d)) != skip]
+                for name in sorted(step[2]):
+                    await paths.put(os.path.join(step[0], name))
+
+        async def reader():
+            while True:
+                path = await paths.get()
+                try:
+                    size = os.path.getsize(path)
+                    # Big files are not read at once, the work function streams those itself
+                    data = await loop.run_in_executor(io_pool, __read_bytes__, path) if size <= large_file else None
+                    await files.put((path, size, data))
+                except Exception as e:
+                    results[os.path.relpath(path, root)] = e
+                    stats['errors'] += 1
+                finally:
+                    paths.task_done()
+
+        async def worker():
+            while True:
+                path, size, data = await files.get()
+                rel = os.path.relpath(path, root)
+                try:
+                    results[rel] = await loop.run_in_executor(cpu_pool, work, path, rel, data)
+                    stats['files'] += 1
+                    stats['bytes'] += size
+                except Exception as e:
+                    results[rel] = e
+                    stats['errors'] += 1
+                finally:
+                    files.task_done()
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(interval)
+                progress(stats)
+
+        tasks = [asyncio.create_task(reader()) for _ in range(concurrency)]
+        tasks += [asyncio.create_task(worker()) for _ in range(concurrency)]
+        if progress is not None:
+            tasks.append(asyncio.create_task(reporter()))
+
+        try:
+            await walker()
+            await paths.join()
+            await files.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    stats['elapsed'] = time.perf_counter() - stats['start']
+    if progress is not None:
+        progress(stats)
+
+    return results, stats
+
+
+def process_tree(root, work, concurrency=None, queue_size=TREE_QUEUE_SIZE, large_file=TREE_LARGE_FILE, progress=None, interval=1,
+                 skip=None):
+    # Run work(path, relative path, data) for every file below root on an asyncio producer/consumer pipeline,
+    # data is the content of the file or None for files bigger than large_file (work has to read those itself).
+    # The directory skip (the output of the work e.g) is left out. progress(stats) is called every interval seconds.
+    # Returns the results (or exceptions) per relative path and the stats.
+    concurrency = concurrency or min(32, (os.cpu_count() or 1) * 2)
+    skip = os.path.abspath(skip) if skip is not None else None
+    return asyncio.run(__process_tree__(root, work, concurrency, queue_size, large_file, progress, interval, skip))
+
+
+def encrypt_tree(key, src, dst, cipher_id=1, codec='none', level=None, concurrency=None, progress=None):
+    # Encrypt every file below src into an envelope with the same relative path (plus ENVELOPE_SUFFIX) below dst
+    def work(path, rel, data):
+        out_path = os.path.join(dst, rel + ENVELOPE_SUFFIX)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        if data is None:
+            encrypt_envelope_file(key, path, out_path, cipher_id=cipher_id, codec=codec, level=level)
+        else:
+            with open(out_path, 'wb') as out:
+                out.write(pack_envelope(key, data, cipher_id=cipher_id, codec=codec, level=level))
+
+        return out_path
+
+    return process_tree(src, work, concurrency, progress=progress, skip=dst)
+
+
+def decrypt_tree(key, src, dst, concurrency=None, progress=None):
+    # The reverse of encrypt_tree, files without ENVELOPE_SUFFIX are reported as errors
+    def work(path, rel, data):
+        if not rel.endswith(ENVELOPE_SUFFIX):
+            raise ValueError('Not an envelope')
+
+        out_path = os.path.join(dst, rel[:-len(ENVELOPE_SUFFIX)])
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        if data is None:
+            decrypt_envelope_file(key, path, out_path)
+        else:
+            txt = unpack_envelope(key, data)
+            with open(out_path, 'wb') as out:
+                out.write(txt)
+
+        return out_path
+
+    return process_tree(src, work, concurrency, progress=progress, skip=dst)
+
+
 class Prompt(Cmd):
     def __init__(self, cls):
         super(Prompt, self).__init__()
@@ -70,6 +1305,66 @@ class Prompt(Cmd):
             'value': None,
             'description': 'Initialization Vector',
             'required': False
+        },
+        'FILE': {
+            'value': None,
+            'description': 'The file to encrypt/decrypt',
+            'required': False
+        },
+        'OUTPUT': {
+            'value': None,
+            'description': 'Where to write the encrypted/decrypted file',
+            'required': False
+        },
+        'MMAP': {
+            'value': 'no',
+            'description': 'Whether or not to memory-map files (yes/no)',
+            'required': False
+        },
+        'WORKERS': {
+            'value': None,
+            'description': 'Amount of processes for parallel mode and of threads for the directory modes (default: all cores)',
+            'required': False
+        },
+        'RANGE': {
+            'value': None,
+            'description': 'Byte range to decrypt from an envelope (start:length)',
+            'required': False
+        },
+        'FIELD': {
+            'value': 'text',
+            'description': 'The JSONL/CSV field that holds the text of a record',
+            'required': False
+        },
+        'COMPRESS': {
+            'value': 'none',
+            'description': 'Compress the text or file before encryption (none, zlib or lzma)',
+            'required': False
+        },
+        'LEVEL': {
+            'value': None,
+            'description': 'Compression level from 0 to 9 (default: codec default)',
+            'required': False
+        },
+        'PASSPHRASE': {
+            'value': None,
+            'description': 'Derive the key from this passphrase instead of using KEY',
+            'required': False
+        },
+        'KDF': {
+            'value': 'scrypt',
+            'description': 'Key derivation function for the passphrase (scrypt or PBKDF2)',
+            'required': False
+        },
+        'SALT': {
+            'value': None,
+            'description': 'Salt for the key derivation function',
+            'required': False
+        },
+        'DIRECTORY': {
+            'value': None,
+            'description': 'The directory to encrypt/decrypt (OUTPUT is the target directory)',
+            'required': False
         }
     }
 
@@ -81,7 +1376,19 @@ class Prompt(Cmd):
             ['unset', 'Unset a certain setting'],
             ['encrypt', 'Encrypt some text (configure first)'],
             ['decrypt', 'Decrypt some text (Configure first)'],
+            ['encrypt-file', 'Encrypt a file (setting: FILE) to OUTPUT'],
+            ['decrypt-file', 'Decrypt a file (setting: FILE) to OUTPUT'],
+            ['encrypt-parallel', 'Encrypt a file into a binary envelope on all cores (AES-GCM or ChaCha20-Poly1305)'],
+            ['decrypt-parallel', 'Decrypt a binary envelope on all cores'],
+            ['decrypt-range', 'Decrypt only a byte range (setting: RANGE) of an envelope'],
+            ['encrypt-dir', 'Encrypt every file in a directory (setting: DIRECTORY) to envelopes in OUTPUT'],
+            ['decrypt-dir', 'Decrypt a directory created by encrypt-dir'],
+            ['encrypt-batch', 'Encrypt every record of a JSONL/CSV file (setting: FILE) with one key'],
+            ['decrypt-batch', 'Decrypt a JSONL file created by encrypt-batch'],
             ['ciphers', 'Obtain a list with supported ciphers'],
+            ['bench', 'Measure the speed of all (or the given) ciphers'],
+            ['keycache', 'View (or \'keycache clear\') the cache of passphrase derived keys'],
+            ['entropy', 'View how much randomness the shared entropy pool has served'],
             ['back', 'Return to the previous prompt']
         ]
         print(tabulate(cmd_list, stralign="center", tablefmt="fancy_grid",
@@ -111,6 +1418,12 @@ class Prompt(Cmd):
 
         # Check if the specified setting exists
         if opt_name in self.settings:
+            if opt_name == 'CIPHER' and opt_value != self.settings['CIPHER']['value']:
+                # The parameters belong to the previous cipher, reusing its nonce with another cipher (under the
+                # same key) would be a nonce reuse
+                for name in ['NONCE', 'IV', 'MAC']:
+                    self.settings[name]['value'] = None
+
             # Split the input into key and value
             self.settings[opt_name]['value'] = opt_value
             print(self.cls['GREEN'] + 'Successfully updated the settings.')
@@ -140,233 +1453,354 @@ class Prompt(Cmd):
             print(self.cls['RED'] + 'There was no text set.')
             return
 
-        txt = txt.encode()
-
-        # Symmetric Blocks
-        if cph == 'AES':
-            # Get or generate the key and nonce
-            key = self.__get_byte_setting__('KEY', 16)
-            nonce = self.__get_byte_setting__('NONCE', 15)
-
-            # Create cipher
-            cip = AES.new(key, AES.MODE_EAX, nonce=nonce)
-
-            # Convert all the byte variables to base64
-            ciptext = bytes_to_base64(cip.encrypt(txt))
-            mac = bytes_to_base64(cip.digest())
-
-            key = bytes_to_base64(key)
-            nonce = bytes_to_base64(nonce)
-
-            # Set some config values automatically
-            self.settings['KEY']['value'] = key
-            self.settings['NONCE']['value'] = nonce
-            self.settings['TEXT']['value'] = ciptext
-            self.settings['MAC']['value'] = mac
-
-            # Print the result
-            print('--=(AES)=--\nKey: {key}\nNonce: {nonce}\nMac: {mac}\nOutput: {output}'.format(
-                key=key, nonce=nonce, mac=mac, output=ciptext))
-        elif cph == 'Single-DES':
-            # Get or generate the key
-            key = self.__get_byte_setting__('KEY', 8)
-
-            # Create cipher
-            cip = DES.new(key, DES.MODE_OFB)
-
-            # Translate some variables into base, including the encrypted bytes
-            ciptext = bytes_to_base64(cip.encrypt(txt))
-            key = bytes_to_base64(key)
-            iv = bytes_to_base64(cip.iv)
-
-            # Set some config values automatically
-            self.settings['TEXT']['value'] = ciptext
-            self.settings['KEY']['value'] = key
-            self.settings['IV']['value'] = iv
-
-            # Print the result
-            print('--=(Single-DES)=--\nKey: {key}\nIV: {iv}\nOutput: {output}'.format(key=key, iv=iv, output=ciptext))
-        elif cph == 'Triple-DES':
-            def gen_des3_key():
-                # So why do we do this?
-                # Well according to the documentation this must be done to
-                # ~ stop Triple DES from degrading to Single DES
-                while 1:
-                    try:
-                        # Set the bits in a TDES key (des3_key to prevent shadowing)
-                        des3_key = DES3.adjust_key_parity(get_random_bytes(24))
-                        break
-                    except ValueError:
-                        pass
-
-                # Finally, return the key
-                return des3_key
-
-            # Check for already configured key
-            if self.settings['KEY']['value'] is not None:
-                # Check if byte is valid
-                if is_valid_byte(24, self.settings['KEY']['value']):
-                    # Set the local key to the configured key
-                    key = base64_to_bytes(self.settings['KEY']['value'])
-                else:
-                    # Generate a new key
-                    key = gen_des3_key()
-            else:
-                key = gen_des3_key()
-
-            cip = DES3.new(key, DES3.MODE_CFB)
-
-            # Translate some variables into base, including the encrypted bytes
-            ciptext = bytes_to_base64(cip.encrypt(txt))
-            key = bytes_to_base64(key)
-            iv = bytes_to_base64(cip.iv)
-
-            self.settings['TEXT']['value'] = ciptext
-            self.settings['KEY']['value'] = key
-            self.settings['IV']['value'] = iv
+        engine = CIPHERS.get(cph)
+        if engine is None:
+            print(self.cls['RED'] + 'You configured an invalid cipher. (Case sensitive)')
+            return
 
-            print('--=(Triple-DES)=--\nKey: {key}\nIV: {iv}\nOutput: {output}'.format(key=key, iv=iv, output=ciptext))
-        elif cph == 'RC2':
-            key = self.__get_byte_setting__('KEY', 16)
+        # Get or generate the key (and the nonce if the cipher takes a configured one)
+        key = self.__get_cipher_key__(engine)
+        if key is None:
+            return
+        nonce = self.__get_byte_setting__('NONCE', engine.nonce_size) if engine.nonce_setting else None
 
-            cip = ARC2.new(key, ARC2.MODE_CFB)
+        compression = self.__get_compression__()
+        if compression is None:
+            return
 
-            ciptext = bytes_to_base64(cip.encrypt(txt))
-            key = bytes_to_base64(key)
-            iv = bytes_to_base64(cip.iv)
+        # Like encrypt_file the codec is the first (encrypted) byte, decryption reads it back from there
+        data = bytes([codec_id(compression[0])]) + compress(compression[0], txt.encode(), compression[1])
+        ciptext, params = engine.encrypt(key, data, nonce=nonce)
 
-            self.settings['TEXT']['value'] = ciptext
-            self.settings['KEY']['value'] = key
-            self.settings['IV']['value'] = iv
+        # Set some config values automatically and print the result
+        self.settings['TEXT']['value'] = bytes_to_base64(ciptext)
+        print(self.__store_params__(cph, key, params, compression[0]) + '\nOutput: ' + self.settings['TEXT']['value'])
 
-            print('--=(RC2)=--\nKey: {key}\nIV: {iv}\nOutput: {output}'.format(key=key, iv=iv, output=ciptext))
-        elif cph == 'CAST-128':
-            key = self.__get_byte_setting__('KEY', 16)
+    def do_decrypt(self, ln):
+        cph = self.settings['CIPHER']['value']
+        txt = self.settings['TEXT']['value'] if self.settings['TEXT']['value'] is None else base64_to_bytes(self.settings['TEXT']['value'])
 
-            cip = CAST.new(key, CAST.MODE_OPENPGP)
+        if txt is None:
+            print(self.cls['RED'] + 'There was no valid base64 text set.')
+            return
 
-            ciptext = bytes_to_base64(cip.encrypt(txt))
-            key = bytes_to_base64(key)
+        engine = CIPHERS.get(cph)
+        if engine is None:
+            print(self.cls['RED'] + 'You configured an invalid cipher. (Case sensitive)')
+            return
 
-            self.settings['TEXT']['value'] = ciptext
-            self.settings['KEY']['value'] = key
+        # This looks ugly but is quite clever:
+        # We will not have to check later if a value is None and if that's not the case convert it using ~
+        # base64_to_bytes and then check again, since this function can also return None
+        key = self.__get_decrypt_key__(engine)
+        nonce = self.settings['NONCE']['value'] if self.settings['NONCE']['value'] is None else base64_to_bytes(self.settings['NONCE']['value'])
+        mac = self.settings['MAC']['value'] if self.settings['MAC']['value'] is None else base64_to_bytes(self.settings['MAC']['value'])
+        iv = self.settings['IV']['value'] if self.settings['IV']['value'] is None else base64_to_bytes(self.settings['IV']['value'])
 
-            print('--=(CAST-128)=--\nKey: {key}\nOutput: {output}'.format(key=key, output=ciptext))
+        # Check whether all the values that this cipher needs are there
+        required = [['SALT' if self.settings['PASSPHRASE']['value'] is not None else 'KEY', key], ['NONCE', engine.nonce_size is not None and nonce],
+                    ['IV', engine.iv_size is not None and not engine.prefix_size and iv],
+                    ['MAC', engine.mac_size is not None and mac]]
+        missing = [' - ' + name for name, value in required if value is None]
+        if missing:
+            print(self.cls['RED'] + '({cph}) The following values are required and must be base64:'.format(cph=cph), *missing, sep='\n')
+            return
 
-        # Symmetric Streams
-        elif cph == 'Salsa20':
-            key = self.__get_byte_setting__('KEY', 32)
+        try:
+            # Verify (authenticated ciphers only), decrypt and decompress it with the codec that it starts with
+            txt = engine.decrypt(key, txt, nonce=nonce, iv=iv, mac=mac)
+            if not txt or txt[0] not in CODECS:
+                raise ValueError('Unknown codec')
+            codec = CODECS[txt[0]]
+            txt = decompress(codec, txt[1:])
+            print(self.cls['GREEN'] + '({cph}, {codec}) Decryption successful: '.format(cph=cph, codec=codec) + self.cls['RESET'] + txt.decode())
+        except ValueError:
+            print(self.cls['RED'] + '({cph}) Decryption failed.'.format(cph=cph))
+
+    def do_encrypt_file(self, _ln):
+        cph = self.settings['CIPHER']['value']
+        paths = self.__get_file_settings__()
+        if paths is None:
+            return
 
-            cip = Salsa20.new(key)
+        engine = CIPHERS.get(cph)
+        if engine is None:
+            print(self.cls['RED'] + 'You configured an invalid cipher. (Case sensitive)')
+            return
 
-            ciptext = bytes_to_base64(cip.encrypt(txt))
-            key = bytes_to_base64(key)
-            nonce = bytes_to_base64(cip.nonce)
+        compression = self.__get_compression__()
+        if compression is None:
+            return
 
-            self.settings['TEXT']['value'] = ciptext
-            self.settings['KEY']['value'] = key
-            self.settings['NONCE']['value'] = nonce
+        key = self.__get_cipher_key__(engine)
+        if key is None:
+            return
+        nonce = self.__get_byte_setting__('NONCE', engine.nonce_size) if engine.nonce_setting else None
 
-            print('--=(Salsa20)=--\nKey: {key}\nNonce: {nonce}\nOutput: {output}'.format(key=key, nonce=nonce,
-                                                                                         output=ciptext))
-        else:
-            print(self.cls['RED'] + 'You configured an invalid cipher. (Case sensitive)')
+        try:
+            params = encrypt_file(cph, key, paths[0], paths[1], nonce=nonce, use_mmap=paths[2],
+                                  codec=compression[0], level=compression[1])
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not encrypt the file: ' + str(e))
             return
 
-    def do_decrypt(self, ln):
+        # Set some config values automatically so the file can be decrypted right away
+        print(self.__store_params__(cph, key, params, compression[0]) + '\nOutput: ' + paths[1])
+
+    def do_decrypt_file(self, _ln):
         cph = self.settings['CIPHER']['value']
-        txt = self.settings['TEXT']['value'] if self.settings['TEXT']['value'] is None else base64_to_bytes(self.settings['TEXT']['value'])
+        paths = self.__get_file_settings__()
+        if paths is None:
+            return
 
-        if txt is None:
-            print(self.cls['RED'] + 'There was no valid base64 text set.')
+        engine = CIPHERS.get(cph)
+        if engine is None:
+            print(self.cls['RED'] + 'You configured an invalid cipher. (Case sensitive)')
             return
 
-        # This looks ugly but is quite clever:
-        # We will not have to check later if a value is None and if that's not the case convert it using ~
-        # base64_to_bytes and then check again, since this function can also return None
-        key = self.settings['KEY']['value'] if self.settings['KEY']['value'] is None else base64_to_bytes(self.settings['KEY']['value'])
+        key = self.__get_decrypt_key__(engine)
         nonce = self.settings['NONCE']['value'] if self.settings['NONCE']['value'] is None else base64_to_bytes(self.settings['NONCE']['value'])
         mac = self.settings['MAC']['value'] if self.settings['MAC']['value'] is None else base64_to_bytes(self.settings['MAC']['value'])
         iv = self.settings['IV']['value'] if self.settings['IV']['value'] is None else base64_to_bytes(self.settings['IV']['value'])
 
-        # Symmetric Blocks
-        if cph == 'AES':
-            if key is None or nonce is None:
-                print(self.cls['RED'] + '(AES) The following values are required and must be base64:', ' - KEY', ' - NONCE', ' - MAC', sep='\n')
-                return
+        if key is None:
+            print(self.cls['RED'] + '({cph}) A KEY (or PASSPHRASE and SALT) is required and must be base64.'.format(cph=cph))
+            return
 
-            # Create cipher
-            cip = AES.new(key, AES.MODE_EAX, nonce=nonce)
+        try:
+            # The codec is stored in the file itself
+            codec = decrypt_file(cph, key, paths[0], paths[1], nonce=nonce, iv=iv, mac=mac, use_mmap=paths[2])
+            print(self.cls['GREEN'] + '({cph}, {codec}) Decryption successful: '.format(cph=cph, codec=codec) + self.cls['RESET'] + paths[1])
+        except (ValueError, TypeError) as e:
+            print(self.cls['RED'] + '({cph}) Decryption failed: '.format(cph=cph) + str(e))
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not decrypt the file: ' + str(e))
+
+    def do_encrypt_parallel(self, _ln):
+        paths = self.__get_file_settings__()
+        workers = get_workers(self.cls, self.settings['WORKERS']['value'])
+        if paths is None or workers == 0:
+            return
 
-            try:
-                # Verify using the mac and decrypt it
-                ciptext = cip.decrypt_and_verify(txt, mac)
-                print(self.cls['GREEN'] + '(AES) Decryption successful: ' + self.cls['RESET'] + ciptext.decode())
-            except ValueError:
-                print(self.cls['RED'] + '(AES) Decryption failed.')
+        cipher_id = self.__get_envelope_cipher__()
+        compression = self.__get_compression__()
+        if compression is None:
+            return
 
-        elif cph == 'Single-DES':
-            if key is None or iv is None:
-                print(self.cls['RED'] + '(Single-DES) The following values are required and must be base64:', ' - KEY',
-                      ' - IV', sep='\n')
-                return
+        cph = ENVELOPE_CIPHERS[cipher_id]
+        key = self.__get_cipher_key__(CIPHERS[cph])
+        if key is None:
+            return
 
-            # Create cipher
-            cip = DES.new(key, DES.MODE_OFB, iv=iv)
-            ciptext = cip.decrypt(txt)
+        start = time.perf_counter()
+        try:
+            encrypt_file_parallel(key, paths[0], paths[1], workers=workers, cipher_id=cipher_id,
+                                  codec=compression[0], level=compression[1])
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not encrypt the file: ' + str(e))
+            return
+        elapsed = time.perf_counter() - start
 
-            print(self.cls['GREEN'] + '(Single-DES) Decryption successful: ' + self.cls['RESET'] + ciptext.decode())
-        elif cph == 'Triple-DES':
-            if key is None or iv is None:
-                print(self.cls['RED'] + '(Triple-DES) The following values are required and must be base64:', ' - KEY',
-                      ' - IV', sep='\n')
-                return
+        print(self.__store_params__(cph + ', parallel', key, {'nonce': None, 'iv': None, 'mac': None}, compression[0]) +
+              '\nOutput: {output}\nSpeed: {speed:.2f} MB/s'.format(output=paths[1], speed=os.path.getsize(paths[0]) / 1e6 / max(elapsed, 1e-9)))
 
-            # Create cipher
-            cip = DES3.new(key, DES3.MODE_CFB, iv=iv)
-            ciptext = cip.decrypt(txt)
+    def do_decrypt_parallel(self, _ln):
+        paths = self.__get_file_settings__()
+        workers = get_workers(self.cls, self.settings['WORKERS']['value'])
+        if paths is None or workers == 0:
+            return
 
-            print(self.cls['GREEN'] + '(Triple-DES) Decryption successful: ' + self.cls['RESET'] + ciptext.decode())
-        elif cph == 'RC2':
-            if key is None or iv is None:
-                print(self.cls['RED'] + '(RC2) The following values are required and must be base64:', ' - KEY', ' - IV', sep='\n')
-                return
+        key = self.__get_envelope_key__(paths[0])
+        if key is None:
+            print(self.cls['RED'] + '(Envelope) A KEY (or PASSPHRASE and SALT) is required and must be base64.')
+            return
 
-            # Create cipher
-            cip = ARC2.new(key, ARC2.MODE_CFB, iv=iv)
-            ciptext = cip.decrypt(txt)
+        start = time.perf_counter()
+        try:
+            decrypt_file_parallel(key, paths[0], paths[1], workers=workers)
+        except ValueError as e:
+            print(self.cls['RED'] + '(Envelope) Decryption failed: ' + str(e))
+            return
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not decrypt the file: ' + str(e))
+            return
+        elapsed = time.perf_counter() - start
 
-            print(self.cls['GREEN'] + '(RC2) Decryption successful: ' + self.cls['RESET'] + ciptext.decode())
-        elif cph == 'CAST-128':
-            if key is None:
-                print(self.cls['RED'] + '(CAST-128) The following values are required and must be base64:', ' - KEY', sep='\n')
-                return
+        print(self.cls['GREEN'] + '(Envelope) Decryption successful: ' + self.cls['RESET'] + paths[1] +
+              ' ({speed:.2f} MB/s)'.format(speed=os.path.getsize(paths[1]) / 1e6 / max(elapsed, 1e-9)))
 
-            # So the iv must be 10 bytes long for decryption (8 for encryption)
-            # and the iv is encrypted and prefixed, so we separate it below
-            iv = txt[:8 + 2]
-            txt = txt[8 + 2:]
+    def do_decrypt_range(self, _ln):
+        paths = self.__get_file_settings__()
+        if paths is None:
+            return
 
-            # Create cipher
-            cip = CAST.new(key, CAST.MODE_OPENPGP, iv=iv)
-            ciptext = cip.decrypt(txt)
+        key = self.__get_envelope_key__(paths[0])
+        if key is None:
+            print(self.cls['RED'] + '(Envelope) A KEY (or PASSPHRASE and SALT) is required and must be base64.')
+            return
 
-            print(self.cls['GREEN'] + '(CAST-128) Decryption successful: ' + self.cls['RESET'] + ciptext.decode())
+        try:
+            start, length = self.settings['RANGE']['value'].split(':')
+            start, length = int(start), int(length)
+        except (AttributeError, ValueError):
+            print(self.cls['RED'] + 'RANGE must be set to start:length (in bytes).')
+            return
 
-        # Symmetric Streams
-        elif cph == 'Salsa20':
-            if key is None or nonce is None:
-                print(self.cls['RED'] + '(Salsa20) The following values are required and must be base64:', ' - KEY', ' - NONCE', sep='\n')
-                return
+        try:
+            txt = decrypt_range(key, paths[0], start, length)
+            with open(paths[1], 'wb') as f:
+                f.write(txt)
+        except ValueError as e:
+            print(self.cls['RED'] + '(Envelope) Decryption failed: ' + str(e))
+            return
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not decrypt the file: ' + str(e))
+            return
 
-            cip = Salsa20.new(key, nonce=nonce)
-            ciptext = cip.decrypt(txt)
+        print(self.cls['GREEN'] + '(Envelope) Decrypted {n} bytes: '.format(n=len(txt)) + self.cls['RESET'] + paths[1])
 
-            print(self.cls['GREEN'] + '(Salsa20) Decryption successful: ' + self.cls['RESET'] + ciptext.decode())
-        else:
+    def do_encrypt_dir(self, _ln):
+        paths = self.__get_dir_settings__()
+        workers = get_workers(self.cls, self.settings['WORKERS']['value'])
+        compression = self.__get_compression__()
+        if paths is None or workers == 0 or compression is None:
+            return
+
+        cipher_id = self.__get_envelope_cipher__()
+        cph = ENVELOPE_CIPHERS[cipher_id]
+        key = self.__get_cipher_key__(CIPHERS[cph])
+        if key is None:
+            return
+
+        results, stats = encrypt_tree(key, paths[0], paths[1], cipher_id=cipher_id, codec=compression[0], level=compression[1],
+                                      concurrency=workers, progress=print_progress)
+
+        print(self.__store_params__(cph + ', directory', key, {'nonce': None, 'iv': None, 'mac': None}, compression[0]) + '\nOutput: ' + paths[1])
+        self.__print_errors__(results)
+
+    def do_decrypt_dir(self, _ln):
+        paths = self.__get_dir_settings__()
+        workers = get_workers(self.cls, self.settings['WORKERS']['value'])
+        if paths is None or workers == 0:
+            return
+
+        # The key size is taken from the configured cipher (AES-GCM if it cannot be used for envelopes)
+        key = self.__get_decrypt_key__(CIPHERS[ENVELOPE_CIPHERS[self.__get_envelope_cipher__()]])
+        if key is None:
+            print(self.cls['RED'] + '(Envelope) A KEY (or PASSPHRASE and SALT) is required and must be base64.')
+            return
+
+        results, stats = decrypt_tree(key, paths[0], paths[1], concurrency=workers, progress=print_progress)
+
+        print(self.cls['GREEN'] + '(Envelope) Decrypted {n} files: '.format(n=stats['files']) + self.cls['RESET'] + paths[1])
+        self.__print_errors__(results)
+
+    def do_encrypt_batch(self, _ln):
+        cph = self.settings['CIPHER']['value']
+        paths = self.__get_file_settings__()
+        if paths is None:
+            return
+
+        engine = CIPHERS.get(cph)
+        if engine is None:
+            print(self.cls['RED'] + 'You configured an invalid cipher. (Case sensitive)')
+            return
+
+        key = self.__get_cipher_key__(engine)
+        if key is None:
+            return
+
+        start = time.perf_counter()
+        try:
+            count = encrypt_batch(cph, key, paths[0], paths[1], self.settings['FIELD']['value'] or 'text')
+        except (KeyError, ValueError) as e:
+            print(self.cls['RED'] + 'Invalid record: ' + str(e))
+            return
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not encrypt the records: ' + str(e))
+            return
+        elapsed = time.perf_counter() - start
+
+        print(self.__store_params__(cph + ', batch', key, {'nonce': None, 'iv': None, 'mac': None}) +
+              '\nRecords: {count}\nOutput: {output}\nSpeed: {speed:.0f} records/s'.format(
+                  count=count, output=paths[1], speed=count / max(elapsed, 1e-9)))
+
+    def do_decrypt_batch(self, _ln):
+        cph = self.settings['CIPHER']['value']
+        paths = self.__get_file_settings__()
+        if paths is None:
+            return
+
+        engine = CIPHERS.get(cph)
+        if engine is None:
             print(self.cls['RED'] + 'You configured an invalid cipher. (Case sensitive)')
             return
 
+        key = self.__get_decrypt_key__(engine)
+        if key is None:
+            print(self.cls['RED'] + '({cph}) A KEY (or PASSPHRASE and SALT) is required and must be base64.'.format(cph=cph))
+            return
+
+        try:
+            count = decrypt_batch(cph, key, paths[0], paths[1], self.settings['FIELD']['value'] or 'text')
+        except (KeyError, TypeError, ValueError) as e:
+            print(self.cls['RED'] + '({cph}) Decryption failed: '.format(cph=cph) + str(e))
+            return
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not decrypt the records: ' + str(e))
+            return
+
+        print(self.cls['GREEN'] + '({cph}) Decrypted {count} records: '.format(cph=cph, count=count) + self.cls['RESET'] + paths[1])
+
+    def do_bench(self, ln):
+        # Benchmark the given ciphers (separated by spaces) or all of them
+        names = ln.split() or list(CIPHERS)
+        for name in names:
+            if name not in CIPHERS:
+                print(self.cls['RED'] + '{name} is not a valid cipher. (Case sensitive)'.format(name=name))
+                return
+
+        print('Measuring {n} cipher(s), this may take a while...'.format(n=len(names)))
+
+        results = {name: [name] for name in names}
+        for size in BENCH_SIZES:
+            # The contents do not matter for the speed, so we use zeroes
+            data = bytes(size)
+            for name in names:
+                speed, latency = benchmark_cipher(CIPHERS[name], data)
+                results[name].append('{speed:.1f} MB/s\n{latency}'.format(speed=speed, latency=format_duration(latency)))
+
+        print(tabulate([results[name] for name in names], stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Cipher" + self.cls['RESET']] +
+                               [self.cls['BLUE'] + format_size(size) + self.cls['RESET'] for size in BENCH_SIZES]))
+
+    def do_keycache(self, ln):
+        if ln.strip().lower() == 'clear':
+            KEY_CACHE.clear()
+            print(self.cls['GREEN'] + 'Successfully cleared the key cache.')
+            return
+
+        lookups = KEY_CACHE.hits + KEY_CACHE.misses
+        print(tabulate([[len(KEY_CACHE.entries), KEY_CACHE.max_size, KEY_CACHE.ttl, KEY_CACHE.hits, KEY_CACHE.misses,
+                         '{rate:.1f}%'.format(rate=100 * KEY_CACHE.hits / lookups if lookups else 0)]],
+                       stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Keys" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Max keys" + self.cls['RESET'],
+                                self.cls['BLUE'] + "TTL (s)" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Hits" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Misses" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Hit rate" + self.cls['RESET']]))
+
+    def do_entropy(self, _ln):
+        # Show how much randomness the shared pool served and how often it went to the OS for it
+        print(tabulate([[format_size(ENTROPY.block_size), format_size(ENTROPY.served), ENTROPY.refills,
+                         format_size(len(ENTROPY.block) - ENTROPY.pos)]],
+                       stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Block size" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Served" + self.cls['RESET'],
+                                self.cls['BLUE'] + "OS reads" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Buffered" + self.cls['RESET']]))
+
     def do_ciphers(self, _ln):
         print(self.cls['BLUE'] + '-----[Symmetric]-----',
               self.cls[
@@ -374,9 +1808,17 @@ class Prompt(Cmd):
               'MODE may differ depending on the cipher, this also explains why some ciphers use',
               'NONCE and others use IV.',
               'AES is the most standard in this PoC and also uses an additional MAC or TAG value to',
-              'verify and decrypt.',
-              self.cls['CYAN'] + 'Block: ' + self.cls['RESET'] + 'AES, Single-DES, Triple-DES, RC2, CAST-128',
-              self.cls['CYAN'] + 'Stream: ' + self.cls['RESET'] + 'Salsa20', sep='\n', end='\n\n')
+              'verify and decrypt. AES-GCM, AES-OCB and ChaCha20-Poly1305 do the same in a single pass',
+              'and are the fastest ones, use \'bench\' to compare them on your hardware.',
+              self.cls['CYAN'] + 'Block: ' + self.cls['RESET'] + ', '.join(e.name for e in CIPHERS.values() if e.kind == 'Block'),
+              self.cls['CYAN'] + 'Stream: ' + self.cls['RESET'] + ', '.join(e.name for e in CIPHERS.values() if e.kind == 'Stream'),
+              sep='\n', end='\n\n')
+
+    def precmd(self, ln):
+        # Commands such as 'encrypt-file' are handled by their do_encrypt_file counterparts
+        arr = ln.split(' ')
+        arr[0] = arr[0].replace('-', '_')
+        return ' '.join(arr)
 
     def default(self, ln):
         ln = ln.lower()
@@ -396,10 +1838,137 @@ class Prompt(Cmd):
                 key = base64_to_bytes(self.settings[setting]['value'])
             else:
                 # The key is invalid so generate a new one
-                key = get_random_bytes(byte_value)
+                key = ENTROPY.get_bytes(byte_value)
         else:
             # If the value is not set generate a new key
-            key = get_random_bytes(byte_value)
+            key = ENTROPY.get_bytes(byte_value)
 
         # Finally return the key
         return key
+
+    def __get_cipher_key__(self, engine):
+        # Derive the key from the passphrase if one is set, a new salt is generated if there is no valid one
+        if self.settings['PASSPHRASE']['value'] is not None:
+            salt = self.__get_byte_setting__('SALT', KDF_SALT_SIZE)
+            self.settings['SALT']['value'] = bytes_to_base64(salt)
+            return self.__derive_key__(engine, salt)
+
+        # Check for an already configured key with the right size, otherwise let the cipher generate one
+        if self.settings['KEY']['value'] is not None and is_valid_byte(engine.key_size, self.settings['KEY']['value']):
+            return base64_to_bytes(self.settings['KEY']['value'])
+
+        return engine.new_key()
+
+    def __store_params__(self, cph, key, params, codec=None):
+        # Store the key and the parameters in the settings (so decryption works right away) and
+        # return them as printable text
+        self.settings['KEY']['value'] = bytes_to_base64(key)
+        output = '--=({cph})=--\nKey: {key}'.format(cph=cph, key=self.settings['KEY']['value'])
+        if codec is not None:
+            self.settings['COMPRESS']['value'] = codec
+            output += '\nCompression: {codec}'.format(codec=codec)
+        if self.settings['PASSPHRASE']['value'] is not None:
+            output += '\nSalt: {salt} ({kdf})'.format(salt=self.settings['SALT']['value'], kdf=self.settings['KDF']['value'])
+
+        for name, label in [['nonce', 'Nonce'], ['iv', 'IV'], ['mac', 'Mac']]:
+            if params[name] is not None:
+                self.settings[name.upper()]['value'] = bytes_to_base64(params[name])
+                output += '\n{label}: {value}'.format(label=label, value=self.settings[name.upper()]['value'])
+
+        return output
+
+    def __get_decrypt_key__(self, engine):
+        # Derive the key from the passphrase and SALT if a passphrase is set, otherwise use KEY (None if it is invalid)
+        if self.settings['PASSPHRASE']['value'] is not None:
+            salt = self.settings['SALT']['value'] if self.settings['SALT']['value'] is None else base64_to_bytes(self.settings['SALT']['value'])
+            return salt if salt is None else self.__derive_key__(engine, salt)
+
+        return self.settings['KEY']['value'] if self.settings['KEY']['value'] is None else base64_to_bytes(self.settings['KEY']['value'])
+
+    def __get_envelope_key__(self, path):
+        # The key size depends on the cipher in the header of the envelope
+        try:
+            with open(path, 'rb') as f:
+                engine = CIPHERS[ENVELOPE_CIPHERS[read_envelope_header(f)[1][2]]]
+        except (OSError, ValueError):
+            # Let the decryption itself report the problem
+            engine = CIPHERS['AES-GCM']
+
+        return self.__get_decrypt_key__(engine)
+
+    def __derive_key__(self, engine, salt):
+        try:
+            key = derive_key(self.settings['PASSPHRASE']['value'], salt, engine.key_size, engine.name, self.settings['KDF']['value'])
+            return engine.adjust_key(key)
+        except ValueError as e:
+            print(self.cls['RED'] + 'Could not derive a key: ' + str(e))
+            return None
+
+    def __get_envelope_cipher__(self):
+        # Use the configured cipher if it can be used for envelopes, AES-GCM otherwise
+        for i, name in ENVELOPE_CIPHERS.items():
+            if name == self.settings['CIPHER']['value']:
+                return i
+
+        return 1
+
+    def __get_dir_settings__(self):
+        src = self.settings['DIRECTORY']['value']
+        dst = self.settings['OUTPUT']['value']
+
+        if src is None or dst is None:
+            print(self.cls['RED'] + 'Both DIRECTORY and OUTPUT must be set.')
+            return None
+
+        if not os.path.isdir(src):
+            print(self.cls['RED'] + 'The configured DIRECTORY does not exist.')
+            return None
+
+        if os.path.abspath(src) == os.path.abspath(dst):
+            print(self.cls['RED'] + 'OUTPUT must be another directory than DIRECTORY.')
+            return None
+
+        return src, dst
+
+    def __print_errors__(self, results):
+        for rel, result in sorted(results.items()):
+            if isinstance(result, Exception):
+                print(self.cls['RED'] + '{rel}: {error}'.format(rel=rel, error=result) + self.cls['RESET'])
+
+    def __get_file_settings__(self):
+        in_path = self.settings['FILE']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        if in_path is None or out_path is None:
+            print(self.cls['RED'] + 'Both FILE and OUTPUT must be set.')
+            return None
+
+        if not os.path.isfile(in_path):
+            print(self.cls['RED'] + 'The configured FILE does not exist.')
+            return None
+
+        use_mmap = get_flag(self.cls, 'MMAP', self.settings['MMAP']['value'])
+        if use_mmap is None:
+            return None
+
+        return in_path, out_path, use_mmap
+
+    def __get_compression__(self):
+        # Returns the codec and the level, or None if the settings are invalid
+        codec = self.settings['COMPRESS']['value'] or 'none'
+        if codec not in CODECS.values():
+            print(self.cls['RED'] + 'COMPRESS must be one of: ' + ', '.join(CODECS.values()))
+            return None
+
+        if self.settings['LEVEL']['value'] is None:
+            return codec, None
+
+        try:
+            level = int(self.settings['LEVEL']['value'])
+            if level < 0 or level > 9:
+                raise ValueError()
+        except ValueError:
+            print(self.cls['RED'] + 'LEVEL must be a number from 0 to 9.')
+            return None
+
+        return codec, level
@@ -1,13 +1,853 @@
+import hashlib
+import heapq
+import hmac
+import json
+import mmap
+import multiprocessing
+import os
+import platform
+import sqlite3
+import ssl
+import struct
+import tempfile
+import threading
+import time
+import numpy as np
 from cmd import Cmd
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from tabulate import tabulate
 
+import Crypto
 from Crypto.Hash import SHA256, SHA512, BLAKE2b, MD5, SHA1
 from Crypto.Protocol.KDF import bcrypt, scrypt
-from Crypto.Random import get_random_bytes
 from base64 import b64encode
 
 from main import MainPrompt
-from encryption import bytes_to_base64, base64_to_bytes
+from encryption import bytes_to_base64, base64_to_bytes, format_size, iter_file_chunks, process_tree, read_records, \
+    get_flag, get_workers, print_progress, ENTROPY
+
+# Algorithms that can hash data of any size (bcrypt and scrypt are meant for passwords)
+DIGESTS = {
+    'SHA-256': SHA256,
+    'SHA-512': SHA512,
+    'BLAKE2b': BLAKE2b,
+    'MD5': MD5,
+    'SHA-1': SHA1
+}
+# Every algorithm is available from two libraries, new_digest() uses whichever one is the fastest on this machine
+# (hashlib is backed by OpenSSL which often uses SHA extensions of the CPU). Both produce the same digests.
+HASH_BACKENDS = OrderedDict([
+    ('hashlib', {
+        'SHA-256': hashlib.sha256,
+        'SHA-512': hashlib.sha512,
+        'BLAKE2b': hashlib.blake2b,
+        'MD5': hashlib.md5,
+        'SHA-1': hashlib.sha1
+    }),
+    ('pycryptodome', {
+        'SHA-256': SHA256.new,
+        'SHA-512': SHA512.new,
+        'BLAKE2b': lambda data=None: BLAKE2b.new(digest_bits=512, data=data),
+        'MD5': MD5.new,
+        'SHA-1': SHA1.new
+    })
+])
+# The result of the backend benchmark is stored here (in the user's cache directory, not wherever the tool runs),
+# it is measured again when the machine or a library changes
+BACKEND_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                             'python-utility-tool', 'hash-backends.json')
+# Every backend hashes a buffer of this size for at least this many seconds
+BACKEND_BENCH_SIZE = 1024 * 1024
+BACKEND_BENCH_TIME = 0.05
+# The selected backend per algorithm and the measured speeds (MB/s), filled by select_backends()
+BACKENDS = {'selected': {}, 'speeds': {}}
+# Threads that need a backend at the same time wait for a single benchmark instead of each running their own
+BACKENDS_LOCK = threading.Lock()
+
+# Files are fed to the hash objects in chunks of this size, large chunks keep the per-call overhead of Python low
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Tree hashing (hash-tree) splits a file into leaves of this size and combines their digests into a Merkle root:
+#   leaf = H(0x00 || leaf data)        (an empty file has a single, empty leaf)
+#   node = H(0x01 || left || right)    (pairs from left to right, an odd node at the end moves up unchanged)
+# The prefixes keep a leaf from ever being mistaken for a node. H is the configured ALGO.
+MERKLE_LEAF_SIZE = 4 * 1024 * 1024
+MERKLE_LEAF_PREFIX = b'\x00'
+MERKLE_NODE_PREFIX = b'\x01'
+
+# Default location of the cache that lets 'manifest' skip files that did not change since the last run
+MANIFEST_CACHE = 'manifest-cache.db'
+# Amount of threads that hash the files that are not in the cache
+MANIFEST_WORKERS = 8
+
+# Default cost parameters of the password hashes. scrypt needs 128 * r * N bytes of memory (64 MB for these).
+# The parameters are stored in the hash itself ($2a$<cost>$... and $scrypt$ln=<log2 N>,r=<r>,p=<p>$...),
+# scrypt hashes without them are from before they could be configured and use the defaults.
+KDF_COSTS = {
+    'bcrypt': {'cost': 12},
+    'scrypt': {'N': 2**16, 'r': 8, 'p': 1}
+}
+# The wordlist of 'audit' is split into (line-aligned) chunks of about this size for the worker processes
+AUDIT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Breached password index (breach-index), built from a dump with a SHA-1 (hex) at the start of every line:
+#   header  magic, version, amount of entries
+#   fan-out amount of entries before every 2 byte prefix (65537 little-endian uint64s)
+#   entries the unique SHA-1 digests (20 bytes each) in sorted order
+BREACH_MAGIC = b'PUTB'
+BREACH_VERSION = 1
+BREACH_HEADER = struct.Struct('>4sB3xQ')
+BREACH_FANOUT = 2**16 + 1
+# The dump is read (and sorted) in parts of this size
+BREACH_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Latency (ms) and memory (MB) that 'calibrate' may spend on a single hash by default
+CALIBRATE_TARGET = 250
+CALIBRATE_MEMORY = 64
+
+
+def benchmark_backends(size=BACKEND_BENCH_SIZE, min_time=BACKEND_BENCH_TIME):
+    # Measure the speed (MB/s) of every backend per algorithm, a backend that is not available
+    # (MD5 on a FIPS system e.g) or that does not produce the same digest as the others is left out
+    data = ENTROPY.get_bytes(size)
+    speeds = {}
+    for algo in DIGESTS:
+        speeds[algo] = {}
+        expected = None
+        for backend, digests in HASH_BACKENDS.items():
+            try:
+                digest = digests[algo]()
+                digest.update(data)
+                digest = digest.hexdigest()
+            except ValueError:
+                continue
+
+            expected = expected or digest
+            if digest != expected:
+                continue
+
+            runs = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < min_time:
+                digests[algo]().update(data)
+                runs += 1
+            speeds[algo][backend] = runs * size / 1e6 / (time.perf_counter() - start)
+
+    return speeds
+
+
+def select_backends(cache_path=BACKEND_CACHE, refresh=False):
+    # Pick the fastest backend per algorithm, the benchmark is only run if there is no (matching) cached result
+    with BACKENDS_LOCK:
+        return __select_backends__(cache_path, refresh)
+
+
+def ensure_backends():
+    # Select the backends if that did not happen yet, returns the selection. Call this before starting a pool
+    # and hand the selection to the workers (see __init_backends__), otherwise every worker benchmarks on its own.
+    with BACKENDS_LOCK:
+        if not BACKENDS['selected']:
+            __select_backends__(BACKEND_CACHE, False)
+        return BACKENDS['selected']
+
+
+def __init_backends__(selected):
+    # Initializer of the worker processes, they use the backends that the parent selected
+    BACKENDS['selected'] = selected
+
+
+def __select_backends__(cache_path, refresh):
+    fingerprint = [platform.machine(), platform.python_version(), ssl.OPENSSL_VERSION, Crypto.__version__]
+
+    speeds = None
+    if not refresh and cache_path is not None:
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached['fingerprint'] == fingerprint:
+                speeds = cached['speeds']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    if speeds is None:
+        speeds = benchmark_backends()
+        if cache_path is not None:
+            try:
+                # Written to a temporary file first, so a process that reads the cache never sees half of it
+                os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+                with open(cache_path + '.tmp', 'w') as f:
+                    json.dump({'fingerprint': fingerprint, 'speeds': speeds}, f)
+                os.replace(cache_path + '.tmp', cache_path)
+            except OSError:
+                # Not being able to cache the result only means the benchmark runs again next time
+                pass
+
+    BACKENDS['speeds'] = speeds
+    BACKENDS['selected'] = {algo: max(speeds[algo], key=speeds[algo].get) if speeds.get(algo) else 'pycryptodome'
+                            for algo in DIGESTS}
+    return BACKENDS
+
+
+def new_digest(algo):
+    # Unlike hash_text (which uses the text as the BLAKE2b key) data is hashed as the message here
+    selected = BACKENDS['selected'] or ensure_backends()
+    return HASH_BACKENDS[selected[algo]][algo]()
+
+
+def hash_file(algo, path, data=None, use_mmap=False, chunk_size=HASH_CHUNK_SIZE):
+    # Hash the given data, or stream the file in chunks if there is no data. The chunks are
+    # memoryviews (of a reused buffer or of the memory map) so nothing is copied on the way.
+    h = new_digest(algo)
+    if data is not None:
+        h.update(data)
+    else:
+        for chunk in iter_file_chunks(path, chunk_size, use_mmap):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def hash_file_multi(algos, path, data=None, use_mmap=False, chunk_size=HASH_CHUNK_SIZE, threads=True):
+    # Compute several digests of the same file while reading it only once, every chunk is handed to all of
+    # the hash objects. The updates run on one thread per algorithm (the hash functions release the GIL)
+    # so this takes about as long as the slowest algorithm on its own. Returns the hex digest per algorithm.
+    hashes = OrderedDict((algo, new_digest(algo)) for algo in algos)
+
+    chunks = [data] if data is not None else iter_file_chunks(path, chunk_size, use_mmap)
+    if not threads or len(hashes) < 2:
+        for chunk in chunks:
+            for h in hashes.values():
+                h.update(chunk)
+    else:
+        with ThreadPoolExecutor(len(hashes)) as pool:
+            for chunk in chunks:
+                # Wait for every update before the next chunk is requested, the chunk's buffer gets reused
+                for future in [pool.submit(h.update, chunk) for h in hashes.values()]:
+                    future.result()
+
+    return OrderedDict((algo, h.hexdigest()) for algo, h in hashes.items())
+
+
+def __hash_leaf__(task):
+    # Runs in a worker process: hash a single leaf of a file
+    algo, path, offset, length, use_mmap = task
+    h = new_digest(algo)
+    h.update(MERKLE_LEAF_PREFIX)
+
+    with open(path, 'rb') as f:
+        if use_mmap and length:
+            # Map only the pages of this leaf (the offset must be a multiple of the allocation granularity)
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            with mmap.mmap(f.fileno(), offset - start + length, access=mmap.ACCESS_READ, offset=start) as mm:
+                with memoryview(mm) as view:
+                    h.update(view[offset - start:])
+        else:
+            f.seek(offset)
+            buf = bytearray(min(length, HASH_CHUNK_SIZE))
+            view = memoryview(buf)
+            while length > 0:
+                n = f.readinto(view[:min(length, len(buf))])
+                if not n:
+                    raise ValueError('The file is shorter than expected')
+                h.update(view[:n])
+                length -= n
+
+    return h.digest()
+
+
+def hash_leaves(algo, path, indices, size, leaf_size=MERKLE_LEAF_SIZE, workers=None, use_mmap=False):
+    # Hash the leaves with the given indices (of a file of size bytes) in a process pool, returns their digests in order
+    tasks = [(algo, path, i * leaf_size, min(leaf_size, size - i * leaf_size), use_mmap) for i in indices]
+    if workers == 1 or len(tasks) < 2:
+        return [__hash_leaf__(task) for task in tasks]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=__init_backends__, initargs=(ensure_backends(),)) as pool:
+        return list(pool.map(__hash_leaf__, tasks))
+
+
+def merkle_root(algo, leaves):
+    # Combine the leaf digests into the root (see MERKLE_LEAF_SIZE for the layout)
+    level = list(leaves)
+    while len(level) > 1:
+        nxt = []
+        for i in range(0, len(level) - 1, 2):
+            h = new_digest(algo)
+            h.update(MERKLE_NODE_PREFIX + level[i] + level[i + 1])
+            nxt.append(h.digest())
+        if len(level) % 2:
+            nxt.append(level[-1])
+        level = nxt
+
+    return level[0]
+
+
+def hash_file_tree(algo, path, leaf_size=MERKLE_LEAF_SIZE, workers=None, use_mmap=False):
+    # Tree hash a file, the result (with every leaf digest) can be stored as JSON and be used by verify_file_tree
+    if algo not in DIGESTS:
+        raise ValueError('Invalid algorithm: ' + str(algo))
+
+    size = os.path.getsize(path)
+    count = max(1, -(-size // leaf_size))
+    leaves = hash_leaves(algo, path, range(count), size, leaf_size, workers, use_mmap)
+
+    return {
+        'algo': algo,
+        'leaf_size': leaf_size,
+        'size': size,
+        'root': merkle_root(algo, leaves).hex(),
+        'leaves': [leaf.hex() for leaf in leaves]
+    }
+
+
+def verify_file_tree(path, tree, start=None, length=None, workers=None, use_mmap=False):
+    # Re-hash only the leaves that overlap the byte range start:length (all of them if there is no range)
+    # and compare them to the recorded ones. Returns the indices of the changed leaves and the new root.
+    size = os.path.getsize(path)
+    if size != tree['size']:
+        raise ValueError('The file size changed ({old} to {new} bytes), the file must be tree hashed again'.format(
+            old=tree['size'], new=size))
+
+    leaf_size = tree['leaf_size']
+    leaves = [bytes.fromhex(leaf) for leaf in tree['leaves']]
+
+    if start is None:
+        indices = range(len(leaves))
+    else:
+        if start < 0 or length < 1 or start + length > size:
+            raise ValueError('The range is outside of the file')
+        indices = range(start // leaf_size, (start + length - 1) // leaf_size + 1)
+
+    changed = []
+    for i, leaf in zip(indices, hash_leaves(tree['algo'], path, indices, size, leaf_size, workers, use_mmap)):
+        if leaf != leaves[i]:
+            changed.append(i)
+            leaves[i] = leaf
+
+    return changed, merkle_root(tree['algo'], leaves).hex()
+
+
+def hash_tree(algo, root, concurrency=None, progress=None):
+    # Hash every file below root on the asyncio pipeline of the encryption module,
+    # returns the hex digest (or exception) per relative path and the stats
+    if algo not in DIGESTS:
+        raise ValueError('Invalid algorithm: ' + str(algo))
+
+    ensure_backends()
+    return process_tree(root, lambda path, rel, data: hash_file(algo, path, data), concurrency, progress=progress)
+
+
+def hash_text(algo, txt, salt, params=None):
+    # Hash a (short) text such as a password, returns the hash and the (base64) salt of bcrypt/scrypt
+    # (a new one is generated if it is None) or None for both if the algorithm is invalid.
+    # params overrides the KDF_COSTS of bcrypt/scrypt.
+    hash_res = None
+    params = dict(KDF_COSTS.get(algo, {}), **(params or {}))
+
+    if algo == 'SHA-256':
+        hash_res = SHA256.new(txt).hexdigest()
+    elif algo == 'SHA-512':
+        hash_res = SHA512.new(txt).hexdigest()
+    elif algo == 'BLAKE2b':
+        hash_res = BLAKE2b.new(key=txt).hexdigest()
+    elif algo == 'bcrypt':
+        if salt is None:
+            salt = ENTROPY.get_bytes(16)
+
+        # bcrypt only support input of 72 bytes long, although we can use a workaround for this
+        # we can first hash the text with something else and encode it to base64
+        base = b64encode(SHA256.new(txt).digest())
+        hash_res = bcrypt(base, cost=params['cost'], salt=salt).decode()  # Cost: 4 to 31, at least 12 is recommended
+
+        salt = bytes_to_base64(salt)
+    elif algo == 'scrypt':
+        if salt is None:
+            salt = ENTROPY.get_bytes(16)
+
+        # key_len = length of key, N = costs, r = block size, p = parallelization
+        key = scrypt(txt, salt, key_len=16, N=params['N'], r=params['r'], p=params['p'])
+        hash_res = '$scrypt$ln={ln},r={r},p={p}${key}'.format(ln=params['N'].bit_length() - 1, r=params['r'], p=params['p'],
+                                                              key=bytes_to_base64(key))
+
+        salt = bytes_to_base64(salt)
+    elif algo == 'MD5':
+        hash_res = MD5.new(txt).hexdigest()
+    elif algo == 'SHA-1':
+        hash_res = SHA1.new(txt).hexdigest()
+
+    return hash_res, salt
+
+
+def parse_kdf_params(algo, hsh):
+    # Read the cost parameters back from a bcrypt/scrypt hash, raises a ValueError for malformed hashes
+    try:
+        if algo == 'bcrypt':
+            return {'cost': int(hsh.split('$')[2])}
+        if algo == 'scrypt':
+            if not hsh.startswith('$scrypt$'):
+                # An older hash, made with the default parameters
+                return dict(KDF_COSTS['scrypt'])
+
+            params = dict(kv.split('=') for kv in hsh.split('$')[2].split(','))
+            return {'N': 2**int(params['ln']), 'r': int(params['r']), 'p': int(params['p'])}
+    except (IndexError, KeyError, ValueError):
+        raise ValueError('Malformed {algo} hash'.format(algo=algo))
+
+    return None
+
+
+def verify_text(algo, txt, hsh, salt):
+    # Hash the text again (with the parameters of the given hash) and compare it to the given hash in constant time
+    res, _salt = hash_text(algo, txt, salt, parse_kdf_params(algo, hsh))
+    if res is None:
+        raise ValueError('Invalid algorithm: ' + str(algo))
+
+    if algo == 'scrypt':
+        # The parameters were taken from the hash, so only the keys have to be compared (older hashes have no prefix)
+        res, hsh = res.rsplit('$', 1)[-1], hsh.rsplit('$', 1)[-1]
+
+    return hmac.compare_digest(res.encode(), hsh.encode())
+
+
+def __verify_row__(row):
+    # Runs in a worker process, returns whether or not the row matches (or the error)
+    try:
+        algo, txt, hsh, salt = row
+        salt = base64_to_bytes(salt) if salt is not None else None
+        if algo in ('bcrypt', 'scrypt') and salt is None:
+            raise ValueError('A (base64) salt is required for ' + algo)
+        return verify_text(algo, txt.encode(), hsh, salt)
+    except (TypeError, ValueError, AttributeError) as e:
+        return e
+
+
+def verify_batch(algo, in_path, out_path, workers=None, progress=None):
+    # Verify every (password, hash, salt) record of a JSONL/CSV file on a process pool, a record may carry
+    # its own 'algo'. The results are written in the order of the input as JSONL: the other fields of the
+    # record (never the password) with "match": true/false or an "error". Only a limited amount of
+    # records is in flight at once, so files of any size can be verified.
+    stats = {'records': 0, 'matches': 0, 'errors': 0, 'start': time.perf_counter()}
+
+    def write(out, record, future):
+        result = future.result()
+        if isinstance(result, Exception):
+            record['error'] = str(result)
+            stats['errors'] += 1
+        else:
+            record['match'] = result
+            stats['matches'] += result
+        stats['records'] += 1
+        out.write(json.dumps(record) + '\n')
+
+        if progress is not None and stats['records'] % 100 == 0:
+            progress(stats)
+
+    with open(out_path, 'w') as out, ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        window = 4 * (workers or os.cpu_count() or 1)
+        for record, txt in read_records(in_path, 'password'):
+            row = (record.pop('algo', None) or algo, txt, record.pop('hash', None), record.pop('salt', None) or None)
+            pending.append((record, pool.submit(__verify_row__, row)))
+
+            # Wait for the oldest record, that way the output stays in the same order as the input
+            if len(pending) >= window:
+                write(out, *pending.popleft())
+
+        while pending:
+            write(out, *pending.popleft())
+
+    stats['elapsed'] = time.perf_counter() - stats['start']
+    return stats
+
+
+def split_lines(path, chunk_size=AUDIT_CHUNK_SIZE):
+    # Return (start, end) byte ranges of about chunk_size bytes that together cover the file, every range ends after a newline
+    size = os.path.getsize(path)
+    if not size:
+        return []
+
+    ranges = []
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b'\n', min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+# Set in every worker process of audit_wordlist by __init_audit__
+__audit__ = {}
+
+
+def __init_audit__(algo, backend, targets, done):
+    __audit__.update(digest=HASH_BACKENDS[backend][algo], targets=targets, done=done)
+
+
+def __audit_chunk__(task):
+    # Runs in a worker process: hash every line (candidate) of a part of the wordlist,
+    # returns the amount of candidates and the (digest, candidate) pairs that were found
+    path, start, end = task
+    if __audit__['done'].is_set():
+        return 0, []
+
+    digest, targets = __audit__['digest'], __audit__['targets']
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        words = mm[start:end].split(b'\n')
+
+    count = 0
+    found = []
+    for word in words:
+        if word.endswith(b'\r'):
+            word = word[:-1]
+        if not word:
+            continue
+
+        count += 1
+        d = digest(word).digest()
+        if d in targets:
+            found.append((d, word))
+
+    return count, found
+
+
+def audit_wordlist(algo, wordlist, targets, workers=None, chunk_size=AUDIT_CHUNK_SIZE, progress=None):
+    # Hash every password of the wordlist with the (unsalted) algorithm and look it up in the set of target
+    # digests (bytes). The wordlist is memory-mapped and split into chunks for a process pool, which stops
+    # as soon as every target was found. Returns {digest: password (bytes)} of the found targets and the stats.
+    if algo not in DIGESTS:
+        raise ValueError('Only unsalted hashes can be audited: ' + ', '.join(DIGESTS))
+
+    selected = ensure_backends()
+    targets = frozenset(targets)
+    found = {}
+    stats = {'candidates': 0, 'targets': len(targets), 'found': 0, 'start': time.perf_counter()}
+    done = multiprocessing.Event()
+
+    tasks = iter([(wordlist, start, end) for start, end in split_lines(wordlist, chunk_size)])
+    with ProcessPoolExecutor(max_workers=workers, initializer=__init_audit__,
+                             initargs=(algo, selected[algo], targets, done)) as pool:
+        pending = set()
+        window = 2 * (workers or os.cpu_count() or 1)
+        while targets:
+            for task in tasks:
+                pending.add(pool.submit(__audit_chunk__, task))
+                if len(pending) >= window:
+                    break
+
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                count, words = future.result()
+                stats['candidates'] += count
+                found.update(words)
+
+            stats['found'] = len(found)
+            if progress is not None:
+                progress(stats)
+
+            # Early exit, the workers skip the chunks they still get
+            if len(found) == len(targets):
+                done.set()
+                for future in pending:
+                    future.cancel()
+                break
+
+    stats['elapsed'] = time.perf_counter() - stats['start']
+    return found, stats
+
+
+def __read_line_blocks__(path, chunk_size):
+    # Yield blocks of about chunk_size bytes that end with a complete line
+    with open(path, 'rb') as f:
+        rest = b''
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                if rest:
+                    yield rest
+                return
+
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            if end:
+                rest = data[end:]
+                yield data[:end]
+            else:
+                rest = data
+
+
+def __iter_sorted_run__(path, size=64 * 1024):
+    run = np.load(path, mmap_mode='r')
+    for pos in range(0, len(run), size):
+        yield from run[pos:pos + size].tolist()
+
+
+def build_breach_index(dump_path, index_path, chunk_size=BREACH_CHUNK_SIZE):
+    # Turn a dump such as the (offline) HIBP SHA-1 list ("<sha1>:<count>" per line) into a breach index,
+    # the dump is sorted in parts that are merged afterwards (a dump that is already sorted is just copied).
+    # Returns the amount of unique entries.
+    runs = []
+    ordered = True
+    last = None
+    try:
+        for block in __read_line_blocks__(dump_path, chunk_size):
+            lines = [ln[:40] for ln in block.split(b'\n') if ln.strip()]
+            hexes = b''.join(lines)
+            try:
+                if len(hexes) != 40 * len(lines):
+                    raise ValueError()
+                digests = np.frombuffer(bytes.fromhex(hexes.decode('ascii')), 'S20')
+            except (ValueError, UnicodeDecodeError):
+                raise ValueError('Every line of the dump must start with a SHA-1 hash (hex)')
+
+            if not len(digests):
+                continue
+            if ordered and (np.any(digests[1:] < digests[:-1]) or (last is not None and digests[0] < last)):
+                ordered = False
+            digests = np.sort(digests)
+            last = digests[-1]
+
+            fd, run = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(index_path)))
+            runs.append(run)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, digests)
+
+        if ordered:
+            entries = (digest for run in runs for digest in __iter_sorted_run__(run))
+        else:
+            entries = heapq.merge(*(__iter_sorted_run__(run) for run in runs))
+
+        counts = np.zeros(BREACH_FANOUT - 1, np.uint64)
+        total = 0
+        with open(index_path + '.tmp', 'wb') as out:
+            # The header and fan-out table are written once all entries are known
+            out.seek(BREACH_HEADER.size + 8 * BREACH_FANOUT)
+
+            previous = None
+            batch = []
+            for digest in entries:
+                # Identical hashes are only stored once (tolist() strips the trailing null bytes, numpy pads them again)
+                if digest != previous:
+                    batch.append(digest)
+                    previous = digest
+                    if len(batch) >= 64 * 1024:
+                        total += __write_breach_batch__(out, batch, counts)
+                        batch = []
+            total += __write_breach_batch__(out, batch, counts)
+
+            out.seek(0)
+            out.write(BREACH_HEADER.pack(BREACH_MAGIC, BREACH_VERSION, total))
+            out.write(np.concatenate([[0], np.cumsum(counts)]).astype('<u8').tobytes())
+        os.replace(index_path + '.tmp', index_path)
+    finally:
+        for run in runs:
+            os.remove(run)
+
+    return total
+
+
+def __write_breach_batch__(out, batch, counts):
+    if not batch:
+        return 0
+
+    digests = np.array(batch, 'S20')
+    raw = digests.view(np.uint8).reshape(-1, 20)
+    counts += np.bincount(raw[:, 0].astype(np.int64) << 8 | raw[:, 1], minlength=len(counts)).astype(np.uint64)
+    out.write(digests.tobytes())
+    return len(digests)
+
+
+class BreachIndex(object):
+    # A breach index that is memory-mapped: only the pages that a lookup touches are ever read.
+    # A single lookup narrows the range down with the fan-out table and binary searches the rest,
+    # contains_many() checks a whole batch of passwords with numpy.
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        try:
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.f.close()
+            raise ValueError('Not a breach index')
+
+        magic, version, self.count = BREACH_HEADER.unpack_from(self.mm)
+        self.offset = BREACH_HEADER.size + 8 * BREACH_FANOUT
+        if magic != BREACH_MAGIC or version != BREACH_VERSION or len(self.mm) != self.offset + 20 * self.count:
+            self.close()
+            raise ValueError('Not a (valid) breach index')
+
+        self.fanout = np.frombuffer(self.mm, '<u8', BREACH_FANOUT, BREACH_HEADER.size)
+        self.entries = np.frombuffer(self.mm, 'S20', self.count, self.offset)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        # Whether or not the SHA-1 digest (20 bytes) is in the index
+        prefix = digest[0] << 8 | digest[1]
+        lo, hi = int(self.fanout[prefix]), int(self.fanout[prefix + 1])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = self.offset + 20 * mid
+            entry = self.mm[pos:pos + 20]
+            if entry < digest:
+                lo = mid + 1
+            elif entry > digest:
+                hi = mid
+            else:
+                return True
+
+        return False
+
+    def contains_password(self, password):
+        if isinstance(password, str):
+            password = password.encode()
+        return hashlib.sha1(password).digest() in self
+
+    def contains_many(self, passwords):
+        # Return a boolean numpy array that tells which of the passwords (bytes) are in the index
+        if not self.count or not passwords:
+            return np.zeros(len(passwords), bool)
+
+        digests = np.frombuffer(b''.join([hashlib.sha1(p).digest() for p in passwords]), 'S20')
+        pos = np.searchsorted(self.entries, digests).clip(max=self.count - 1)
+        return self.entries[pos] == digests
+
+    def close(self):
+        # The numpy views have to be gone before the map can be closed
+        self.fanout = self.entries = None
+        self.mm.close()
+        self.f.close()
+
+
+def __time_kdf__(algo, params):
+    start = time.perf_counter()
+    hash_text(algo, b'calibrate', bytes(16), params)
+    return time.perf_counter() - start
+
+
+def calibrate_kdf(target=CALIBRATE_TARGET, max_memory=CALIBRATE_MEMORY):
+    # Find the largest bcrypt cost and scrypt N (r and p stay at their defaults) that take at most target ms
+    # per hash on this machine, scrypt may also not use more than max_memory MB. Every step doubles
+    # the work, so the search stops as soon as the next step is expected to take too long.
+    # Returns the parameters and the measured time (s) per algorithm.
+    target /= 1000
+    result = {}
+
+    cost = 4
+    elapsed = __time_kdf__('bcrypt', {'cost': cost})
+    while cost < 31 and elapsed * 2 <= target:
+        cost += 1
+        elapsed = __time_kdf__('bcrypt', {'cost': cost})
+    result['bcrypt'] = ({'cost': cost}, elapsed)
+
+    r, p = KDF_COSTS['scrypt']['r'], KDF_COSTS['scrypt']['p']
+    n = 2**10
+    elapsed = __time_kdf__('scrypt', {'N': n, 'r': r, 'p': p})
+    while elapsed * 2 <= target and 128 * r * n * 2 <= max_memory * 1024 * 1024:
+        n *= 2
+        elapsed = __time_kdf__('scrypt', {'N': n, 'r': r, 'p': p})
+    result['scrypt'] = ({'N': n, 'r': r, 'p': p}, elapsed)
+
+    return result
+
+
+class ManifestCache(object):
+    # Remembers the digest of every file together with its size, modification time (ns) and inode in SQLite,
+    # a file whose stat still matches is not read again. Only the thread that created it may use it.
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT NOT NULL, algo TEXT NOT NULL, size INTEGER NOT NULL, '
+                        'mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (path, algo))')
+
+    def load(self, algo, root):
+        # Return {path: (size, mtime_ns, inode, digest)} for every cached file below root
+        prefix = os.path.join(root, '')
+        rows = self.db.execute('SELECT path, size, mtime_ns, inode, digest FROM hashes WHERE algo = ? AND substr(path, 1, ?) = ?',
+                               (algo, len(prefix), prefix))
+        return {row[0]: row[1:] for row in rows}
+
+    def update(self, algo, entries, removed):
+        # Store the (path, size, mtime_ns, inode, digest) entries and forget the removed paths in a single transaction
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                                ((e[0], algo) + tuple(e[1:]) for e in entries))
+            self.db.executemany('DELETE FROM hashes WHERE path = ? AND algo = ?', ((path, algo) for path in removed))
+
+    def close(self):
+        self.db.close()
+
+
+def scan_tree(root, skip=()):
+    # Yield (path, stat) for every regular file below root, os.scandir hands out the stat of most entries for free
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False) and entry.path not in skip:
+                        yield entry.path, entry.stat(follow_symlinks=False)
+        except OSError:
+            # Unreadable directories are skipped, like os.walk does
+            pass
+
+
+def build_manifest(algo, root, cache_path=MANIFEST_CACHE, workers=MANIFEST_WORKERS):
+    # Hash every file below root, files whose size, mtime and inode did not change since the previous run
+    # are taken from the cache. Returns the hex digest (or exception) per relative path and the stats.
+    if algo not in DIGESTS:
+        raise ValueError('Invalid algorithm: ' + str(algo))
+
+    root = os.path.abspath(root)
+    cache_path = os.path.abspath(cache_path)
+    ensure_backends()
+    start = time.perf_counter()
+    stats = {'files': 0, 'hits': 0, 'misses': 0, 'bytes': 0, 'errors': 0}
+    results = {}
+
+    cache = ManifestCache(cache_path)
+    try:
+        cached = cache.load(algo, root)
+        entries = []
+        with ThreadPoolExecutor(workers) as pool:
+            futures = []
+            # The cache (and its journal) may be stored inside of the tree itself
+            for path, st in scan_tree(root, skip=(cache_path, cache_path + '-journal')):
+                rel = os.path.relpath(path, root)
+                key = (st.st_size, st.st_mtime_ns, st.st_ino)
+                stats['files'] += 1
+
+                entry = cached.pop(path, None)
+                if entry is not None and entry[:3] == key:
+                    stats['hits'] += 1
+                    results[rel] = entry[3]
+                    continue
+
+                stats['misses'] += 1
+                futures.append((path, rel, key, pool.submit(hash_file, algo, path)))
+
+            for path, rel, key, future in futures:
+                try:
+                    results[rel] = future.result()
+                    stats['bytes'] += key[0]
+                    entries.append((path,) + key + (results[rel],))
+                except Exception as e:
+                    stats['errors'] += 1
+                    results[rel] = e
+
+        # Whatever is left in cached was not found anymore
+        cache.update(algo, entries, cached)
+    finally:
+        cache.close()
+
+    stats['elapsed'] = time.perf_counter() - start
+    return results, stats
 
 
 class Prompt(Cmd):
@@ -37,6 +877,91 @@ class Prompt(Cmd):
             'value': None,
             'description': 'Additional safeguard value',
             'required': False
+        },
+        'BCRYPT_COST': {
+            'value': KDF_COSTS['bcrypt']['cost'],
+            'description': 'bcrypt cost (4 to 31), every step doubles the time',
+            'required': True
+        },
+        'SCRYPT_N': {
+            'value': KDF_COSTS['scrypt']['N'],
+            'description': 'scrypt cost (a power of 2), uses 128 * R * N bytes of memory',
+            'required': True
+        },
+        'SCRYPT_R': {
+            'value': KDF_COSTS['scrypt']['r'],
+            'description': 'scrypt block size',
+            'required': True
+        },
+        'SCRYPT_P': {
+            'value': KDF_COSTS['scrypt']['p'],
+            'description': 'scrypt parallelization',
+            'required': True
+        },
+        'TARGET': {
+            'value': CALIBRATE_TARGET,
+            'description': 'Maximum time (ms) per bcrypt/scrypt hash (Only for calibrate)',
+            'required': True
+        },
+        'MEMORY': {
+            'value': CALIBRATE_MEMORY,
+            'description': 'Maximum memory (MB) per scrypt hash (Only for calibrate)',
+            'required': True
+        },
+        'WORDLIST': {
+            'value': None,
+            'description': 'Password list (one per line) to audit the hashes of FILE with (Only for audit)',
+            'required': False
+        },
+        'BREACHES': {
+            'value': None,
+            'description': 'Breach index (from breach-index) to check TEXT against (Only for breach-check)',
+            'required': False
+        },
+        'ALGOS': {
+            'value': 'all',
+            'description': 'Comma separated algorithms for hash-multi (or \'all\')',
+            'required': False
+        },
+        'FILE': {
+            'value': None,
+            'description': 'The file to hash (or the records for verify-batch and audit)',
+            'required': False
+        },
+        'MMAP': {
+            'value': 'no',
+            'description': 'Whether or not to memory-map FILE (yes/no)',
+            'required': False
+        },
+        'DIRECTORY': {
+            'value': None,
+            'description': 'The directory to hash (Only for hash-dir)',
+            'required': False
+        },
+        'OUTPUT': {
+            'value': None,
+            'description': 'File to write the hashes of hash-dir/manifest or the leaves of hash-tree to (prints them if unset)',
+            'required': False
+        },
+        'CACHE': {
+            'value': MANIFEST_CACHE,
+            'description': 'Database that remembers the hashes of unchanged files (Only for manifest)',
+            'required': False
+        },
+        'LEAVES': {
+            'value': None,
+            'description': 'Leaf file written by hash-tree (Only for verify-tree)',
+            'required': False
+        },
+        'RANGE': {
+            'value': None,
+            'description': 'Byte range to re-verify with verify-tree (start:length, the whole file if unset)',
+            'required': False
+        },
+        'WORKERS': {
+            'value': None,
+            'description': 'Amount of processes for hash-tree, verify-tree and verify-batch (all cores if unset)',
+            'required': False
         }
     }
 
@@ -48,6 +973,18 @@ class Prompt(Cmd):
             ['unset', 'Unset a certain setting'],
             ['hash', 'Hash some text (configure first)'],
             ['compare', 'Compare a hash (setting: TEXT) with a generated hash (setting: HASH)'],
+            ['audit', 'Look up the hashes of FILE (ALGO, unsalted) in a WORDLIST, matches go to OUTPUT'],
+            ['breach-index', 'Build a breach index (to OUTPUT) from a SHA-1 password dump (FILE)'],
+            ['breach-check', 'Check whether TEXT appears in the BREACHES index'],
+            ['calibrate', 'Pick the bcrypt/scrypt costs that fit the TARGET time and MEMORY of this machine'],
+            ['verify-batch', 'Compare every password, hash & salt of a JSONL/CSV FILE on all cores, results go to OUTPUT'],
+            ['hash-file', 'Hash a file of any size (setting: FILE)'],
+            ['hash-multi', 'Compute several hashes (setting: ALGOS) of FILE (or TEXT) in one pass'],
+            ['hash-tree', 'Merkle tree hash FILE on all cores, the leaves are stored in OUTPUT'],
+            ['verify-tree', 'Re-verify (a RANGE of) FILE against the LEAVES of hash-tree'],
+            ['hash-dir', 'Hash every file in a directory (setting: DIRECTORY)'],
+            ['manifest', 'Hash DIRECTORY, files that did not change since the last run are taken from the CACHE'],
+            ['backends', 'Show (or \'backends refresh\') the speed of the hash libraries per algorithm'],
             ['algos', 'Obtain a list with supported hashing algorithms'],
         ]
         print(tabulate(cmd_list, stralign="center", tablefmt="fancy_grid",
@@ -108,8 +1045,12 @@ class Prompt(Cmd):
         if salt is not None:
             salt = base64_to_bytes(salt)
 
+        params = self.__get_kdf_params__(algo)
+        if params is None:
+            return
+
         # Generate a hash
-        res, salt = self.__hash_text__(algo, txt.encode(), salt)
+        res, salt = hash_text(algo, txt.encode(), salt, params)
         if res is None:
             print(self.cls['RED'] + 'You configured an invalid algorithm. (Case sensitive)')
             return
@@ -138,16 +1079,394 @@ class Prompt(Cmd):
                 print(self.cls['RED'] + 'A salt is required for that algorithm.')
                 return
 
-        res, salt = self.__hash_text__(algo, txt.encode(), salt)
-        if res is None:
-            print(self.cls['RED'] + 'You configured an invalid algorithm. (Case sensitive)')
+        # The cost parameters are taken from the hash itself
+        try:
+            identical = verify_text(algo, txt.encode(), hsh, salt)
+        except ValueError as e:
+            print(self.cls['RED'] + str(e))
             return
 
-        if res == hsh:
+        if identical:
             print(self.cls['GREEN'] + '--=({algo})=--\nHashed & Compared: IDENTICAL HASH'.format(algo=algo))
         else:
             print(self.cls['RED'] + '--=({algo})=--\nHashed & Compared: DIFFERENT HASH'.format(algo=algo))
 
+    def do_audit(self, _ln):
+        algo = self.settings['ALGO']['value']
+        in_path = self.settings['FILE']['value']
+        wordlist = self.settings['WORDLIST']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        if algo not in DIGESTS:
+            print(self.cls['RED'] + 'Only unsalted hashes can be audited: ' + ', '.join(DIGESTS))
+            return
+
+        if in_path is None or not os.path.isfile(in_path) or wordlist is None or not os.path.isfile(wordlist):
+            print(self.cls['RED'] + 'FILE and WORDLIST must be set to existing files.')
+            return
+
+        workers = get_workers(self.cls, self.settings['WORKERS']['value'])
+        if workers == 0:
+            return
+
+        # The records (an id e.g) are kept so the matches can be reported per record
+        try:
+            records = [(record, bytes.fromhex(hsh.strip())) for record, hsh in read_records(in_path, 'hash')]
+            found, stats = audit_wordlist(algo, wordlist, [d for _record, d in records], workers,
+                                          progress=self.__print_audit__)
+        except (KeyError, ValueError, AttributeError) as e:
+            print(self.cls['RED'] + 'Invalid record: ' + str(e))
+            return
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not audit the hashes: ' + str(e))
+            return
+        self.__print_audit__(stats)
+
+        matches = [dict(record, hash=d.hex(), password=found[d].decode('utf-8', 'backslashreplace'))
+                   for record, d in records if d in found]
+        if out_path is not None:
+            with open(out_path, 'w') as f:
+                f.write(''.join(json.dumps(match) + '\n' for match in matches))
+
+        print((self.cls['RED'] if matches else self.cls['GREEN']) +
+              '--=({algo})=--\n{n} of {total} records use a password from the wordlist'.format(
+                  algo=algo, n=len(matches), total=len(records)) + self.cls['RESET'] +
+              ('' if out_path is None or not matches else ': ' + out_path))
+
+    def do_breach_index(self, _ln):
+        in_path = self.settings['FILE']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        if in_path is None or out_path is None:
+            print(self.cls['RED'] + 'Both FILE and OUTPUT must be set.')
+            return
+
+        if not os.path.isfile(in_path):
+            print(self.cls['RED'] + 'The configured FILE does not exist.')
+            return
+
+        start = time.perf_counter()
+        try:
+            count = build_breach_index(in_path, out_path)
+        except ValueError as e:
+            print(self.cls['RED'] + str(e))
+            return
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not build the index: ' + str(e))
+            return
+
+        print(self.cls['GREEN'] + '--=(SHA-1)=--\nIndexed {n} hashes in {t:.1f} s: '.format(
+            n=count, t=time.perf_counter() - start) + self.cls['RESET'] + out_path)
+
+    def do_breach_check(self, _ln):
+        txt = self.settings['TEXT']['value']
+        path = self.settings['BREACHES']['value']
+
+        if txt is None:
+            print(self.cls['RED'] + 'There was no text set.')
+            return
+
+        try:
+            breaches = BreachIndex(path)
+        except (OSError, TypeError, ValueError) as e:
+            print(self.cls['RED'] + 'Could not open the BREACHES index: ' + str(e))
+            return
+
+        try:
+            breached = breaches.contains_password(txt)
+        finally:
+            breaches.close()
+
+        if breached:
+            print(self.cls['RED'] + '--=(breaches)=--\nThis text appears in the breached passwords.')
+        else:
+            print(self.cls['GREEN'] + '--=(breaches)=--\nThis text does not appear in the breached passwords.')
+
+    def do_calibrate(self, _ln):
+        try:
+            target = float(self.settings['TARGET']['value'])
+            memory = float(self.settings['MEMORY']['value'])
+            if target <= 0 or memory <= 0:
+                raise ValueError()
+        except ValueError:
+            print(self.cls['RED'] + 'TARGET and MEMORY must be numbers that are greater than 0.')
+            return
+
+        print('Calibrating bcrypt and scrypt, this takes a few seconds...')
+        result = calibrate_kdf(target, memory)
+
+        bcrypt_params, bcrypt_time = result['bcrypt']
+        scrypt_params, scrypt_time = result['scrypt']
+        self.settings['BCRYPT_COST']['value'] = bcrypt_params['cost']
+        self.settings['SCRYPT_N']['value'] = scrypt_params['N']
+        self.settings['SCRYPT_R']['value'] = scrypt_params['r']
+        self.settings['SCRYPT_P']['value'] = scrypt_params['p']
+
+        print(tabulate([['bcrypt', 'cost={cost}'.format(**bcrypt_params), '{t:.0f} ms'.format(t=bcrypt_time * 1000), '-'],
+                        ['scrypt', 'N=2^{ln}, r={r}, p={p}'.format(ln=scrypt_params['N'].bit_length() - 1, **scrypt_params),
+                         '{t:.0f} ms'.format(t=scrypt_time * 1000),
+                         format_size(128 * scrypt_params['r'] * scrypt_params['N'])]],
+                       stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Algorithm" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Parameters" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Time" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Memory" + self.cls['RESET']]))
+        print(self.cls['GREEN'] + 'Successfully updated the settings.')
+
+    def do_verify_batch(self, _ln):
+        in_path = self.settings['FILE']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        if in_path is None or out_path is None:
+            print(self.cls['RED'] + 'Both FILE and OUTPUT must be set.')
+            return
+
+        if not os.path.isfile(in_path):
+            print(self.cls['RED'] + 'The configured FILE does not exist.')
+            return
+
+        workers = get_workers(self.cls, self.settings['WORKERS']['value'])
+        if workers == 0:
+            return
+
+        try:
+            stats = verify_batch(self.settings['ALGO']['value'], in_path, out_path, workers, progress=self.__print_verified__)
+        except (KeyError, ValueError) as e:
+            print(self.cls['RED'] + 'Invalid record: ' + str(e))
+            return
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not verify the records: ' + str(e))
+            return
+        self.__print_verified__(stats)
+
+        print(self.cls['GREEN'] + '--=(batch)=--\nVerified {n} records: '.format(n=stats['records']) + self.cls['RESET'] + out_path)
+
+    def do_hash_file(self, _ln):
+        algo = self.settings['ALGO']['value']
+        path = self.settings['FILE']['value']
+
+        if algo not in DIGESTS:
+            print(self.cls['RED'] + 'Files can only be hashed with: ' + ', '.join(DIGESTS))
+            return
+
+        if path is None or not os.path.isfile(path):
+            print(self.cls['RED'] + 'The configured FILE does not exist.')
+            return
+
+        use_mmap = get_flag(self.cls, 'MMAP', self.settings['MMAP']['value'])
+        if use_mmap is None:
+            return
+
+        # The benchmark of the first run should not count towards the speed
+        ensure_backends()
+        start = time.perf_counter()
+        try:
+            res = hash_file(algo, path, use_mmap=use_mmap)
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not hash the file: ' + str(e))
+            return
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        size = os.path.getsize(path)
+        print('--=({algo})=--\nFile: {path}\nHash: {output}\nSpeed: {speed:.1f} MB/s'.format(
+            algo=algo, path=path, output=res, speed=size / 1e6 / elapsed))
+
+    def do_hash_multi(self, _ln):
+        algos = self.settings['ALGOS']['value']
+        path = self.settings['FILE']['value']
+        txt = self.settings['TEXT']['value']
+
+        if algos is None or algos.strip().lower() == 'all':
+            algos = list(DIGESTS)
+        else:
+            algos = [a.strip() for a in algos.split(',') if a.strip()]
+            if not algos or any(a not in DIGESTS for a in algos):
+                print(self.cls['RED'] + 'ALGOS must be \'all\' or a comma separated list of: ' + ', '.join(DIGESTS))
+                return
+
+        # The file is hashed if one is configured, the text otherwise
+        if path is not None:
+            if not os.path.isfile(path):
+                print(self.cls['RED'] + 'The configured FILE does not exist.')
+                return
+            data = None
+            size = os.path.getsize(path)
+        elif txt is not None:
+            data = txt.encode()
+            size = len(data)
+        else:
+            print(self.cls['RED'] + 'There was no file or text set.')
+            return
+
+        use_mmap = get_flag(self.cls, 'MMAP', self.settings['MMAP']['value'])
+        if use_mmap is None:
+            return
+
+        # The benchmark of the first run should not count towards the speed
+        ensure_backends()
+        start = time.perf_counter()
+        try:
+            results = hash_file_multi(algos, path, data=data, use_mmap=use_mmap)
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not hash the file: ' + str(e))
+            return
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        if data is not None and 'BLAKE2b' in results:
+            # 'hash' uses the text as the BLAKE2b key, here it is hashed as the message (like a file)
+            results = OrderedDict((algo + ' (unkeyed)' if algo == 'BLAKE2b' else algo, res) for algo, res in results.items())
+
+        print(tabulate(list(results.items()), stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Algorithm" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Hash" + self.cls['RESET']]))
+        print('Speed: {speed:.1f} MB/s'.format(speed=size / 1e6 / elapsed))
+
+    def do_hash_tree(self, _ln):
+        algo = self.settings['ALGO']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        if algo not in DIGESTS:
+            print(self.cls['RED'] + 'Files can only be tree hashed with: ' + ', '.join(DIGESTS))
+            return
+
+        opts = self.__get_tree_settings__()
+        if opts is None:
+            return
+
+        # The benchmark of the first run should not count towards the speed
+        ensure_backends()
+        start = time.perf_counter()
+        try:
+            tree = hash_file_tree(algo, opts[0], workers=opts[1], use_mmap=opts[2])
+        except (OSError, ValueError) as e:
+            print(self.cls['RED'] + 'Could not hash the file: ' + str(e))
+            return
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        if out_path is not None:
+            try:
+                with open(out_path, 'w') as f:
+                    json.dump(tree, f)
+            except OSError as e:
+                print(self.cls['RED'] + 'Could not write the OUTPUT: ' + str(e))
+                return
+
+        print('--=({algo} tree)=--\nRoot: {root}\nLeaves: {n} of {size}\nSpeed: {speed:.1f} MB/s'.format(
+            algo=algo, root=tree['root'], n=len(tree['leaves']), size=format_size(tree['leaf_size']),
+            speed=tree['size'] / 1e6 / elapsed) + ('' if out_path is None else '\nOutput: ' + out_path))
+
+    def do_verify_tree(self, _ln):
+        leaves_path = self.settings['LEAVES']['value']
+        if leaves_path is None or not os.path.isfile(leaves_path):
+            print(self.cls['RED'] + 'The configured LEAVES file does not exist.')
+            return
+
+        opts = self.__get_tree_settings__()
+        if opts is None:
+            return
+
+        start, length = None, None
+        if self.settings['RANGE']['value'] is not None:
+            try:
+                start, length = self.settings['RANGE']['value'].split(':')
+                start, length = int(start), int(length)
+            except ValueError:
+                print(self.cls['RED'] + 'RANGE must be set to start:length (in bytes).')
+                return
+
+        try:
+            with open(leaves_path) as f:
+                tree = json.load(f)
+            changed, root = verify_file_tree(opts[0], tree, start, length, workers=opts[1], use_mmap=opts[2])
+        except (OSError, ValueError, KeyError) as e:
+            print(self.cls['RED'] + 'Could not verify the file: ' + str(e))
+            return
+
+        if not changed:
+            print(self.cls['GREEN'] + '--=({algo} tree)=--\nVerified: IDENTICAL'.format(algo=tree['algo']))
+            return
+
+        leaf_size = tree['leaf_size']
+        print(self.cls['RED'] + '--=({algo} tree)=--\nVerified: {n} CHANGED LEAVES'.format(algo=tree['algo'], n=len(changed)) +
+              self.cls['RESET'])
+        print(tabulate([[i, '{start}:{length}'.format(start=i * leaf_size, length=min(leaf_size, tree['size'] - i * leaf_size))]
+                        for i in changed], stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Leaf" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Range" + self.cls['RESET']]))
+        print('New root: ' + root)
+
+    def do_hash_dir(self, _ln):
+        algo = self.settings['ALGO']['value']
+        root = self.settings['DIRECTORY']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        if algo not in DIGESTS:
+            print(self.cls['RED'] + 'Directories can only be hashed with: ' + ', '.join(DIGESTS))
+            return
+
+        if root is None or not os.path.isdir(root):
+            print(self.cls['RED'] + 'The configured DIRECTORY does not exist.')
+            return
+
+        results, stats = hash_tree(algo, root, progress=print_progress)
+        try:
+            self.__write_hashes__(algo, results, out_path)
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not write the OUTPUT: ' + str(e))
+
+    def do_manifest(self, _ln):
+        algo = self.settings['ALGO']['value']
+        root = self.settings['DIRECTORY']['value']
+        cache_path = self.settings['CACHE']['value'] or MANIFEST_CACHE
+
+        if algo not in DIGESTS:
+            print(self.cls['RED'] + 'Directories can only be hashed with: ' + ', '.join(DIGESTS))
+            return
+
+        if root is None or not os.path.isdir(root):
+            print(self.cls['RED'] + 'The configured DIRECTORY does not exist.')
+            return
+
+        try:
+            results, stats = build_manifest(algo, root, cache_path)
+        except sqlite3.Error as e:
+            print(self.cls['RED'] + 'Could not use the CACHE: ' + str(e))
+            return
+
+        try:
+            self.__write_hashes__(algo, results, self.settings['OUTPUT']['value'])
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not write the OUTPUT: ' + str(e))
+            return
+
+        print(tabulate([[stats['files'], stats['misses'], stats['hits'],
+                         '{rate:.1f}%'.format(rate=100 * stats['hits'] / stats['files'] if stats['files'] else 0),
+                         format_size(stats['bytes']), stats['errors'], '{t:.2f} s'.format(t=stats['elapsed'])]],
+                       stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Files" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Hashed" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Cached" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Hit rate" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Read" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Errors" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Time" + self.cls['RESET']]))
+
+    def do_backends(self, ln):
+        if ln.strip().lower() == 'refresh':
+            print('Measuring the hash libraries...')
+        backends = select_backends(refresh=ln.strip().lower() == 'refresh')
+
+        rows = []
+        for algo in DIGESTS:
+            speeds = backends['speeds'].get(algo, {})
+            rows.append([algo, backends['selected'][algo]] +
+                        ['{speed:.0f} MB/s'.format(speed=speeds[b]) if b in speeds else '-' for b in HASH_BACKENDS])
+
+        print(tabulate(rows, stralign="center", tablefmt="fancy_grid",
+                       headers=[self.cls['BLUE'] + "Algorithm" + self.cls['RESET'],
+                                self.cls['BLUE'] + "Used" + self.cls['RESET']] +
+                               [self.cls['BLUE'] + b + self.cls['RESET'] for b in HASH_BACKENDS]))
+
     def do_algos(self, _ln):
         print(self.cls['BLUE'] + '-----[ALGORITHMS]-----', self.cls['RESET'] +
               'Be aware that some of the algorithms like MD5 and SHA-1 are not '
@@ -157,6 +1476,12 @@ class Prompt(Cmd):
               'to implement support for longer strings.', self.cls['CYAN'] +
               'Algorithms: ' + self.cls['RESET'] + 'SHA-256, SHA-512, BLAKE2b, bcrypt, scrypt, MD5, SHA-1', sep='\n', end='\n\n')
 
+    def precmd(self, ln):
+        # Commands such as 'hash-dir' are handled by their do_hash_dir counterparts
+        arr = ln.split(' ')
+        arr[0] = arr[0].replace('-', '_')
+        return ' '.join(arr)
+
     def default(self, ln):
         ln = ln.lower()
 
@@ -166,36 +1491,66 @@ class Prompt(Cmd):
 
         print(self.cls['RED'] + 'That\'s not a valid command. Use \'help\' for a list of commands.' + self.cls['RESET'])
 
-    def __hash_text__(self, algo, txt, salt):
-        hash_res = None
+    def __write_hashes__(self, algo, results, out_path):
+        # Same format as sha256sum and friends: "<hash>  <path>", raises an OSError if out_path cannot be written
+        lines = []
+        for rel, result in sorted(results.items()):
+            if isinstance(result, Exception):
+                print(self.cls['RED'] + '{rel}: {error}'.format(rel=rel, error=result) + self.cls['RESET'])
+            else:
+                lines.append('{hash}  {rel}'.format(hash=result, rel=rel))
 
-        if algo == 'SHA-256':
-            hash_res = SHA256.new(txt).hexdigest()
-        elif algo == 'SHA-512':
-            hash_res = SHA512.new(txt).hexdigest()
-        elif algo == 'BLAKE2b':
-            hash_res = BLAKE2b.new(key=txt).hexdigest()
-        elif algo == 'bcrypt':
-            if salt is None:
-                salt = get_random_bytes(16)
+        if out_path is None:
+            print('--=({algo})=--'.format(algo=algo), *lines, sep='\n')
+        else:
+            with open(out_path, 'w') as f:
+                f.write(''.join(ln + '\n' for ln in lines))
+            print(self.cls['GREEN'] + '--=({algo})=--\nHashed {n} files: '.format(algo=algo, n=len(lines)) + self.cls['RESET'] + out_path)
 
-            # bcrypt only support input of 72 bytes long, although we can use a workaround for this
-            # we can first hash the text with something else and encode it to base64
-            base = b64encode(SHA256.new(txt).digest())
-            hash_res = bcrypt(base, cost=12, salt=salt).decode()  # Cost: 4 to 31, at least 12 is recommended
+    def __get_tree_settings__(self):
+        path = self.settings['FILE']['value']
+        if path is None or not os.path.isfile(path):
+            print(self.cls['RED'] + 'The configured FILE does not exist.')
+            return None
 
-            salt = bytes_to_base64(salt)
-        elif algo == 'scrypt':
-            if salt is None:
-                salt = get_random_bytes(16)
+        workers = get_workers(self.cls, self.settings['WORKERS']['value'])
+        if workers == 0:
+            return None
+
+        use_mmap = get_flag(self.cls, 'MMAP', self.settings['MMAP']['value'])
+        if use_mmap is None:
+            return None
+
+        return path, workers, use_mmap
+
+    def __get_kdf_params__(self, algo):
+        # The cost parameters of bcrypt/scrypt (an empty dict for the other algorithms), None if they are invalid
+        try:
+            if algo == 'bcrypt':
+                cost = int(self.settings['BCRYPT_COST']['value'])
+                if not 4 <= cost <= 31:
+                    raise ValueError()
+                return {'cost': cost}
+            if algo == 'scrypt':
+                params = {'N': int(self.settings['SCRYPT_N']['value']), 'r': int(self.settings['SCRYPT_R']['value']),
+                          'p': int(self.settings['SCRYPT_P']['value'])}
+                if params['N'] < 2 or params['N'] & (params['N'] - 1) or params['r'] < 1 or params['p'] < 1:
+                    raise ValueError()
+                return params
+        except ValueError:
+            print(self.cls['RED'] + 'BCRYPT_COST must be 4 to 31, SCRYPT_N a power of 2 and SCRYPT_R/SCRYPT_P at least 1.')
+            return None
 
-            # key_len = length of key, N = costs, r = block size, p = parallelization
-            hash_res = bytes_to_base64(scrypt(txt, salt, key_len=16, N=2**16, r=8, p=1))
+        return {}
 
-            salt = bytes_to_base64(salt)
-        elif algo == 'MD5':
-            hash_res = MD5.new(txt).hexdigest()
-        elif algo == 'SHA-1':
-            hash_res = SHA1.new(txt).hexdigest()
+    def __print_audit__(self, stats):
+        elapsed = max(time.perf_counter() - stats['start'], 1e-9)
+        print('\r{candidates} candidates, {found}/{targets} found, {speed:.0f} candidates/s'.format(
+            candidates=stats['candidates'], found=stats['found'], targets=stats['targets'], speed=stats['candidates'] / elapsed),
+            end='\n' if 'elapsed' in stats else '', flush=True)
 
-        return hash_res, salt
+    def __print_verified__(self, stats):
+        elapsed = max(time.perf_counter() - stats['start'], 1e-9)
+        print('\r{records} records, {matches} matches, {mismatches} mismatches, {errors} errors, {speed:.1f} records/s'.format(
+            records=stats['records'], matches=stats['matches'], mismatches=stats['records'] - stats['matches'] - stats['errors'],
+            errors=stats['errors'], speed=stats['records'] / elapsed), end='\n' if 'elapsed' in stats else '', flush=True)
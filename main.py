@@ -1,6 +1,5 @@
 from cmd import Cmd
 from tabulate import tabulate
-from distutils import util
 
 
 # Command class for the main prompt
@@ -47,12 +46,15 @@ class MainPrompt(Cmd):
 
 # Main function (prevents unnecessary global scope variables)
 def main():
+    # Imported here, encryption itself imports this module for MainPrompt
+    from encryption import strtobool
+
     print('Does your prompt support ANSI colours?')
 
     allow_colours = None
     while allow_colours is None:
         try:
-            allow_colours = bool(util.strtobool(input('Enter \'yes\' or \'no\': ')))
+            allow_colours = strtobool(input('Enter \'yes\' or \'no\': '))
         except ValueError:
             print('You must enter either \'yes\' or \'no\'.')
 
@@ -1,10 +1,258 @@
-from distutils import util
 from cmd import Cmd
 from tabulate import tabulate
+import math
+import mmap
+import os
 import string
-import random
+import time
+import numpy as np
 
 from main import MainPrompt
+from encryption import ENTROPY, strtobool
+from hashing import BreachIndex
+
+# Bulk passwords are generated (and written) this many at a time, memory usage does not depend on COUNT
+PASSWORD_BATCH = 64 * 1024
+# Passphrases are generated this many at a time
+PASSPHRASE_BATCH = 4 * 1024
+# Filtering gives up after this many batches in a row without a single new password
+PASSWORD_MAX_EMPTY_BATCHES = 1000
+# Saving the deduplicator merges this many stored fingerprints at a time into the new file
+DEDUP_MERGE_CHUNK = 1024 * 1024
+# The offsets of the words in a wordlist are stored next to it in a file with this suffix
+WORDLIST_INDEX_SUFFIX = '.idx.npy'
+
+
+def generate_passwords(char_set, length, count, batch=PASSWORD_BATCH):
+    # Yield blocks (bytes) of newline separated passwords drawn uniformly from char_set (an ASCII string).
+    # Random bytes are pulled in bulk and mapped onto the characters with bytes.translate: bytes that
+    # would make the modulo biased are deleted (rejection sampling) instead of being looped over one by one.
+    char_set = char_set.encode()
+    n = len(char_set)
+    limit = 256 - 256 % n
+    table = bytes(char_set[b % n] for b in range(256))
+    rejected = bytes(range(limit, 256))
+
+    while count > 0:
+        k = min(batch, count)
+        need = k * length
+
+        chars = bytearray()
+        while len(chars) < need:
+            # Ask for a bit more than expected so a second round is rarely needed
+            missing = need - len(chars)
+            chars += ENTROPY.get_bytes(missing * 256 // limit + 64).translate(table, rejected)
+
+        # Character i of every password is written in one go, followed by the newlines
+        out = bytearray(k * (length + 1))
+        for i in range(length):
+            out[i::length + 1] = chars[i * k:(i + 1) * k]
+        out[length::length + 1] = b'\n' * k
+
+        count -= k
+        yield bytes(out)
+
+
+class PasswordDeduplicator(object):
+    # Remembers a 64-bit fingerprint of every password that was ever issued (8 bytes per password) so a
+    # password is never handed out twice. The fingerprints of earlier runs are kept sorted in a .npy file
+    # that is memory-mapped, the ones of this run are kept in a few sorted runs that are merged when
+    # they grow (like a log-structured merge tree) so looking up and adding a batch stays cheap.
+    # Two different passwords can (very rarely) share a fingerprint, the second one is simply regenerated.
+    def __init__(self, path):
+        self.path = path
+        self.runs = []
+        self.issued = np.load(path, mmap_mode='r') if os.path.isfile(path) and os.path.getsize(path) else np.empty(0, np.uint64)
+
+    @staticmethod
+    def fingerprints(block, length):
+        # Hash every (newline terminated) password of a block: FNV-1a over the columns and a final mix (from splitmix64)
+        rows = np.frombuffer(block, np.uint8).reshape(-1, length + 1)
+        h = np.full(len(rows), 0xcbf29ce484222325 ^ length, np.uint64)
+        for i in range(length):
+            h ^= rows[:, i]
+            h *= np.uint64(0x100000001b3)
+
+        h ^= h >> np.uint64(30)
+        h *= np.uint64(0xbf58476d1ce4e5b9)
+        h ^= h >> np.uint64(27)
+        h *= np.uint64(0x94d049bb133111eb)
+        h ^= h >> np.uint64(31)
+        return h
+
+    def __contains_any__(self, fps, sorted_fps):
+        if not len(sorted_fps):
+            return np.zeros(len(fps), bool)
+        pos = np.searchsorted(sorted_fps, fps).clip(max=len(sorted_fps) - 1)
+        return sorted_fps[pos] == fps
+
+    def add(self, fps):
+        # Return a mask of the fingerprints that were not seen before (and remember those)
+        # Of duplicates within the batch only the first one is kept
+        _unique, first = np.unique(fps, return_index=True)
+        fresh = np.zeros(len(fps), bool)
+        fresh[first] = True
+
+        for sorted_fps in [self.issued] + self.runs:
+            fresh &= ~self.__contains_any__(fps, sorted_fps)
+
+        self.runs.append(np.sort(fps[fresh]))
+        # Merge runs of a similar size, there are never more than about log2(n) of them
+        while len(self.runs) > 1 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            last = self.runs.pop()
+            self.runs[-1] = np.sort(np.concatenate([self.runs[-1], last]))
+
+        return fresh
+
+    def __len__(self):
+        return len(self.issued) + sum(len(run) for run in self.runs)
+
+    def save(self, chunk=DEDUP_MERGE_CHUNK):
+        # Write all fingerprints (sorted) to a temporary file first so an interrupted save cannot lose the old ones.
+        # The stored ones are merged with the new ones a chunk at a time, so they are never all loaded into memory.
+        fresh = np.sort(np.concatenate(self.runs)) if self.runs else np.empty(0, np.uint64)
+        total = len(self.issued) + len(fresh)
+        if not total:
+            np.save(self.path + '.tmp', fresh)
+        else:
+            out = np.lib.format.open_memmap(self.path + '.tmp', mode='w+', dtype=np.uint64, shape=(total,))
+            pos = j = 0
+            for i in range(0, len(self.issued), chunk):
+                stored = np.asarray(self.issued[i:i + chunk])
+                # The new fingerprints up to the last stored one of this chunk (the last chunk takes all that are left)
+                end = len(fresh) if i + chunk >= len(self.issued) else np.searchsorted(fresh, stored[-1], 'right')
+                merged = np.sort(np.concatenate([stored, fresh[j:end]]))
+                out[pos:pos + len(merged)] = merged
+                pos += len(merged)
+                j = end
+            out[pos:] = fresh[j:]
+            out.flush()
+            del out
+        self.issued = None
+        os.replace(self.path + '.tmp', self.path)
+        self.issued = np.load(self.path, mmap_mode='r')
+        self.runs = []
+
+
+def random_below(n, k):
+    # Return k uniformly distributed integers in [0, n) as a numpy array, values that would make
+    # the modulo biased are rejected (like ENTROPY.randbelow but for a whole batch at once)
+    limit = 2**64 - 2**64 % n
+    values = np.empty(0, np.uint64)
+    while len(values) < k:
+        draw = np.frombuffer(ENTROPY.get_bytes(8 * (k - len(values) + 16)), '<u8')
+        values = np.concatenate([values, draw[draw < limit] if limit < 2**64 else draw])
+
+    return values[:k] % np.uint64(n)
+
+
+class Wordlist(object):
+    # A (diceware) wordlist that is memory-mapped together with an index of where every word starts and ends,
+    # so picking a word takes O(1) and the list is never loaded into memory. The index is built once and
+    # again whenever the wordlist changes. Lines such as "11111<TAB>word" (diceware lists) only use the word.
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + WORDLIST_INDEX_SUFFIX
+
+        index_time = os.path.getmtime(self.index_path) if os.path.isfile(self.index_path) else -1
+        if index_time < os.path.getmtime(path):
+            self.build_index()
+
+        self.index = np.load(self.index_path, mmap_mode='r')
+        if not len(self.index):
+            raise ValueError('The wordlist has no words')
+
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def build_index(self):
+        # Store the (start, end) offsets of every non-empty word as a (n, 2) uint64 array
+        size = os.path.getsize(self.path)
+        if size:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                data = np.frombuffer(mm, np.uint8)
+                newlines = np.flatnonzero(data == ord('\n'))
+                starts = np.concatenate([[0], newlines + 1])
+                ends = np.concatenate([newlines, [size]])
+
+                # Words follow the last tab of the line and a \r in front of the newline is not a part of them
+                tabs = np.flatnonzero(data == ord('\t'))
+                if len(tabs):
+                    last_tab = np.searchsorted(tabs, ends) - 1
+                    has_tab = (last_tab >= 0) & (tabs[last_tab.clip(0)] >= starts)
+                    starts = np.where(has_tab, tabs[last_tab.clip(0)] + 1, starts)
+                cr = (ends > starts) & (data[(ends - 1).clip(0)] == ord('\r'))
+                ends = ends - cr
+                del data
+
+            keep = ends > starts
+            index = np.stack([starts[keep], ends[keep]], axis=1).astype(np.uint64)
+        else:
+            index = np.empty((0, 2), np.uint64)
+
+        with open(self.index_path + '.tmp', 'wb') as f:
+            np.save(f, index)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def __len__(self):
+        return len(self.index)
+
+    def word(self, i):
+        start, end = self.index[i]
+        return self.mm[int(start):int(end)]
+
+    def close(self):
+        self.mm.close()
+
+
+def generate_passphrases(wordlist, words, count, separator=' ', breaches=None, batch=PASSPHRASE_BATCH):
+    # Yield blocks (bytes) of newline separated passphrases of words random words from the wordlist,
+    # passphrases that are in the breach index (if given) are replaced
+    separator = separator.encode()
+    while count > 0:
+        k = min(batch, count)
+        picks = wordlist.index[random_below(len(wordlist), k * words)].tolist()
+        mm = wordlist.mm
+
+        lines = []
+        for p in range(0, k * words, words):
+            lines.append(separator.join([mm[start:end] for start, end in picks[p:p + words]]))
+
+        if breaches is not None:
+            lines = [ln for ln, breached in zip(lines, breaches.contains_many(lines)) if not breached]
+
+        count -= len(lines)
+        if lines:
+            yield b'\n'.join(lines) + b'\n'
+
+
+def generate_filtered_passwords(char_set, length, count, dedup=None, breaches=None, batch=PASSWORD_BATCH):
+    # Like generate_passwords, but every password that is in the breach index or that the deduplicator
+    # has seen before is dropped and replaced (breached ones never count as issued)
+    if dedup is not None:
+        # The passwords of this run that were not saved yet count as well
+        left = len(char_set) ** length - len(dedup)
+        if left < count:
+            raise ValueError('Only {left} unique passwords of this length and character set are left'.format(left=max(left, 0)))
+
+    empty = 0
+    while count > 0:
+        for block in generate_passwords(char_set, length, min(count, batch), batch):
+            rows = np.frombuffer(block, np.uint8).reshape(-1, length + 1)
+            if breaches is not None:
+                rows = rows[~breaches.contains_many(block.split(b'\n')[:-1])]
+            if dedup is not None:
+                rows = rows[dedup.add(PasswordDeduplicator.fingerprints(rows.tobytes(), length))]
+
+            # Stop instead of looping forever when (nearly) every password left is breached or issued
+            empty = 0 if len(rows) else empty + 1
+            if empty >= PASSWORD_MAX_EMPTY_BATCHES:
+                raise ValueError('No new password was found in {n} batches, too few are left that are not breached or issued'.format(
+                    n=PASSWORD_MAX_EMPTY_BATCHES))
+
+            count -= len(rows)
+            if len(rows):
+                yield rows.tobytes()
 
 
 class Prompt(Cmd):
@@ -39,6 +287,34 @@ class Prompt(Cmd):
             'value': False,
             'description': 'Whether or not to include duplicate characters',
         },
+        'COUNT': {
+            'value': 1,
+            'description': 'The amount of passwords to generate',
+        },
+        'OUTPUT': {
+            'value': None,
+            'description': 'File to write the passwords to, one per line (prints them if unset)',
+        },
+        'WORDLIST': {
+            'value': None,
+            'description': 'Wordlist to pick the words of a passphrase from (one word per line)',
+        },
+        'WORDS': {
+            'value': 6,
+            'description': 'The amount of words in a passphrase',
+        },
+        'SEPARATOR': {
+            'value': ' ',
+            'description': 'The text between the words of a passphrase',
+        },
+        'DEDUP': {
+            'value': None,
+            'description': 'File that remembers all issued passwords so none is issued twice (off if unset)',
+        },
+        'BREACHES': {
+            'value': None,
+            'description': 'Breach index (see hashing) of passwords that may never be issued (off if unset)',
+        },
     }
 
     def do_help(self, _ln):
@@ -46,7 +322,8 @@ class Prompt(Cmd):
         cmd_list = [
             ['settings', 'View current settings'],
             ['set', 'Set the value of a setting'],
-            ['generate', 'Generate a password'],
+            ['generate', 'Generate a password (or COUNT passwords)'],
+            ['passphrase', 'Generate a passphrase (or COUNT passphrases) of WORDS words from the WORDLIST'],
             ['back', 'Return to the previous prompt']
         ]
         print(tabulate(cmd_list, stralign="center", tablefmt="fancy_grid",
@@ -72,16 +349,21 @@ class Prompt(Cmd):
 
         # Check if the specified setting exists
         if opt_name in self.settings:
-            if opt_name == 'LENGTH':
+            if opt_name == 'LENGTH' or opt_name == 'COUNT' or opt_name == 'WORDS':
                 try:
-                    self.settings['LENGTH']['value'] = int(opt_value)
+                    self.settings[opt_name]['value'] = int(opt_value)
                 except ValueError:
                     print(self.cls['RED'] + 'You must enter a number.')
                     return
+            elif opt_name in ('OUTPUT', 'DEDUP', 'WORDLIST', 'BREACHES'):
+                # An empty value unsets the file
+                self.settings[opt_name]['value'] = opt_value or None
+            elif opt_name == 'SEPARATOR':
+                self.settings['SEPARATOR']['value'] = opt_value
             else:
                 try:
                     # Try to convert the input to a boolean
-                    self.settings[opt_name]['value'] = bool(util.strtobool(opt_value))
+                    self.settings[opt_name]['value'] = strtobool(opt_value)
                 except ValueError:
                     # Catch a value error and display a message
                     print(self.cls['RED'] + 'You must enter either \'yes\' or \'no\'.')
@@ -117,21 +399,137 @@ class Prompt(Cmd):
         if sym:
             char_set += string.punctuation
 
+        count = self.settings['COUNT']['value']
+        out_path = self.settings['OUTPUT']['value']
+        if count < 1:
+            print(self.cls['RED'] + 'You must at least generate one password.')
+            return
+
+        if count > 1 or out_path is not None or self.settings['DEDUP']['value'] is not None or \
+                self.settings['BREACHES']['value'] is not None:
+            self.__generate_bulk__(char_set, lng, count, out_path)
+            return
+
         # Convert string chararacter set to array
         char_set = list(char_set)
 
         if self.settings['DUPLICATES']['value']:
             pwd = ''
             for i in range(0, lng):
-                pwd += char_set[random.randint(0, len(char_set) - 1)]
+                pwd += ENTROPY.choice(char_set)
 
             print(self.cls['GREEN'] + 'Password successfully generated: ' + pwd)
         else:
-            random.shuffle(char_set)
-            pwd_arr = random.choices(char_set, k=lng)
+            ENTROPY.shuffle(char_set)
+            pwd_arr = ENTROPY.choices(char_set, k=lng)
 
             print(self.cls['GREEN'] + 'Password successfully generated: ' + ''.join(pwd_arr))
 
+    def do_passphrase(self, _ln):
+        path = self.settings['WORDLIST']['value']
+        words = self.settings['WORDS']['value']
+        count = self.settings['COUNT']['value']
+        out_path = self.settings['OUTPUT']['value']
+
+        if path is None or not os.path.isfile(path):
+            print(self.cls['RED'] + 'The configured WORDLIST does not exist.')
+            return
+
+        if words < 1 or count < 1:
+            print(self.cls['RED'] + 'You must at least generate one passphrase of one word.')
+            return
+
+        breaches = self.__open_breaches__()
+        if breaches is False:
+            return
+
+        start = time.perf_counter()
+        try:
+            wordlist = Wordlist(path)
+        except (OSError, ValueError) as e:
+            print(self.cls['RED'] + 'Could not open the wordlist: ' + str(e))
+            if breaches is not None:
+                breaches.close()
+            return
+
+        try:
+            blocks = generate_passphrases(wordlist, words, count, self.settings['SEPARATOR']['value'], breaches)
+            if out_path is None:
+                for block in blocks:
+                    print(self.cls['GREEN'] + block.decode('utf-8', 'replace'), end='')
+            else:
+                with open(out_path, 'wb') as f:
+                    for block in blocks:
+                        f.write(block)
+        except OSError as e:
+            print(self.cls['RED'] + 'Could not write the passphrases: ' + str(e))
+            return
+        finally:
+            wordlist.close()
+            if breaches is not None:
+                breaches.close()
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        # Every word is picked uniformly (and independently) from the whole list
+        print(self.cls['RESET'] + 'Entropy: {bits:.1f} bits per passphrase ({n} words, {per_word:.2f} bits each)'.format(
+            bits=words * math.log2(len(wordlist)), n=len(wordlist), per_word=math.log2(len(wordlist))))
+        if out_path is not None:
+            print(self.cls['GREEN'] + '{count} passphrases successfully generated ({speed:.0f}/s): '.format(
+                count=count, speed=count / elapsed) + self.cls['RESET'] + out_path)
+
+    def __open_breaches__(self):
+        # The index of the BREACHES setting (None if it is unset), False if it could not be opened
+        if self.settings['BREACHES']['value'] is None:
+            return None
+
+        try:
+            return BreachIndex(self.settings['BREACHES']['value'])
+        except (OSError, ValueError) as e:
+            print(self.cls['RED'] + 'Could not open the BREACHES index: ' + str(e))
+            return False
+
+    def __generate_bulk__(self, char_set, lng, count, out_path):
+        # Every character is drawn from the whole set (as a single password does)
+        breaches = self.__open_breaches__()
+        if breaches is False:
+            return
+
+        start = time.perf_counter()
+        dedup = None
+        try:
+            if self.settings['DEDUP']['value'] is not None:
+                dedup = PasswordDeduplicator(self.settings['DEDUP']['value'])
+
+            if dedup is None and breaches is None:
+                blocks = generate_passwords(char_set, lng, count)
+            else:
+                blocks = generate_filtered_passwords(char_set, lng, count, dedup, breaches)
+
+            if out_path is None:
+                for block in blocks:
+                    print(block.decode(), end='')
+            else:
+                with open(out_path, 'wb') as f:
+                    for block in blocks:
+                        f.write(block)
+
+            # The passwords only count as issued once they were all written
+            if dedup is not None:
+                dedup.save()
+        except (OSError, ValueError) as e:
+            print(self.cls['RED'] + 'Could not generate the passwords: ' + str(e))
+            return
+        finally:
+            if breaches is not None:
+                breaches.close()
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        if out_path is None:
+            return
+
+        print(self.cls['GREEN'] + '{count} passwords successfully generated ({speed:.0f}/s): '.format(
+            count=count, speed=count / elapsed) + self.cls['RESET'] + out_path)
+
     def default(self, ln):
         ln = ln.lower()
 